@@ -5,13 +5,32 @@
 # ==============================================================================
 
 import os
+import json
+import socket
+import base64
+import hashlib
+import struct
+import heapq
+import queue
+import signal
+import asyncio
+import aiohttp
 import requests
 import time
 import psycopg2
+import psycopg2.pool
+import psycopg2.extras
 import traceback
-from datetime import datetime, timedelta
-from flask import Flask
-from threading import Thread
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from flask import Flask, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from threading import Thread, Lock, RLock, BoundedSemaphore, Event
+from urllib.parse import urlsplit
 
 # --- 1. CONFIGURAÇÕES E VARIÁVEIS DE AMBIENTE ---
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -22,174 +41,1594 @@ TARGET_CHAIN = 'solana'
 GOPLUS_CHAIN_ID = 'solana_mainnet' 
 
 MAX_PAIR_AGE_HOURS = 4
+GECKOTERMINAL_MAX_PAGES = int(os.environ.get('GECKOTERMINAL_MAX_PAGES', 10)) # Páginas do new_pools percorridas por ciclo (a API não serve além da 10ª)
+# Fontes de descoberta consultadas em paralelo a cada ciclo (nomes de DISCOVERY_SOURCE_FETCHERS)
+DISCOVERY_SOURCES = [source.strip() for source in os.environ.get('DISCOVERY_SOURCES', 'geckoterminal,dexscreener').split(',') if source.strip()]
+# Descoberta em tempo real: logsSubscribe no websocket do RPC (nomes de STREAM_SOURCES, ex. 'raydium,pumpfun'; vazio desativa).
+# Opcional e desligada por padrão: o filtro `mentions` entrega os logs de TODAS as transações dos programas (cada swap,
+# muitas mensagens por segundo), e cada lançamento da Pump.fun vira um token em monitoramento, com perfil e coleta próprios.
+RPC_WS_URL = os.environ.get('RPC_WS_URL') or (RPC_URL or '').replace('https://', 'wss://', 1).replace('http://', 'ws://', 1) or None
+STREAM_DISCOVERY_SOURCES = [source.strip() for source in os.environ.get('STREAM_DISCOVERY_SOURCES', '').split(',') if source.strip()]
+STREAM_SESSION_SECONDS = int(os.environ.get('STREAM_SESSION_SECONDS', 600)) # Duração de cada conexão antes de reconectar (e renovar o heartbeat do worker)
+STREAM_IDLE_TIMEOUT_SECONDS = 120 # Sem nenhuma mensagem por esse tempo, a conexão é considerada morta
+CYCLE_INTERVAL_SECONDS = int(os.environ.get('CYCLE_INTERVAL_SECONDS', 900)) # Cadência alvo entre ciclos de descoberta
+
+# Workers independentes (descoberta -> perfilamento -> coleta) ligados por filas em memória
+PROFILING_QUEUE_SIZE = int(os.environ.get('PROFILING_QUEUE_SIZE', 1000)) # Acima disso a descoberta espera o perfilamento (backpressure)
+PROFILING_BATCH_SIZE = int(os.environ.get('PROFILING_BATCH_SIZE', 50)) # Candidatos perfilados e gravados por rodada
+PROFILING_RECOVERY_GRACE_SECONDS = 600 # Tokens sem perfil há mais tempo que isso voltam para a fila (perdidos num restart ou erro)
+WORKER_ERROR_BACKOFF_SECONDS = 60
+
+# Amostragem por faixa de idade: (idade máxima em horas, segundos entre amostras); tokens mais velhos usam SAMPLING_INTERVAL_OLD_TOKENS
+SAMPLING_TIERS = [(1, 30), (6, 120), (24, 300), (72, 900)]
+SAMPLING_INTERVAL_OLD_TOKENS = 3600
+SAMPLING_VOLATILITY_LOOKBACK = 12 # Amostras recentes usadas no cálculo da volatilidade
+# Janela de tempo em que essas amostras são buscadas; limita a leitura às partições recentes de market_data
+SAMPLING_VOLATILITY_WINDOW_SECONDS = SAMPLING_VOLATILITY_LOOKBACK * SAMPLING_INTERVAL_OLD_TOKENS
+SAMPLING_VOLATILE_THRESHOLD = 0.05 # Desvio padrão dos retornos acima do qual o intervalo cai pela metade
+SAMPLING_QUIET_THRESHOLD = 0.005 # Abaixo disso o intervalo dobra (até SAMPLING_INTERVAL_OLD_TOKENS)
+COLLECTION_TICK_SECONDS = int(os.environ.get('COLLECTION_TICK_SECONDS', 15)) # Frequência com que a fila de tokens devidos é verificada
+SAMPLING_REFRESH_SECONDS = 60 # Frequência com que a lista de tokens monitorados é recarregada do banco
+
+# Sharding entre réplicas: cada réplica viva coleta uma fatia disjunta dos tokens (rendezvous hashing sobre tokens.id)
+SHARDING_MODE = os.environ.get('SHARDING_MODE', 'none') # 'none' ou 'hash'
+REPLICA_ID = os.environ.get('REPLICA_ID') or f"{socket.gethostname()}-{os.getpid()}"
+REPLICA_HEARTBEAT_TIMEOUT_SECONDS = int(os.environ.get('REPLICA_HEARTBEAT_TIMEOUT_SECONDS', 3 * SAMPLING_REFRESH_SECONDS)) # Sem heartbeat por esse tempo, a fatia da réplica é redistribuída
 DEATH_LIQUIDITY_THRESHOLD_USD = 2000
 DEATH_VOLUME_THRESHOLD_USD = 1000
+DEXSCREENER_BATCH_SIZE = 30 # Máximo de pares aceitos pela DexScreener em uma única requisição
+HOLDER_COUNT_STRATEGY = os.environ.get('HOLDER_COUNT_STRATEGY', 'slice') # 'slice' (getProgramAccounts + dataSlice) ou 'das' (getTokenAccounts, RPC Helius)
+HOLDER_COUNT_PAGE_SIZE = 1000 # Limite de contas por página do getTokenAccounts
+SPL_TOKEN_PROGRAM_ID = 'TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA'
+RAYDIUM_AMM_V4_PROGRAM_ID = '675kPX9MHTjS2zt1qfr1NYHuzeLXfQM9H24wFSUt1Mp8'
+PUMPFUN_PROGRAM_ID = '6EF8rrecthR5Dkzon8Nwu78hRvfCKubJ14M5uBEwF6P'
+WSOL_MINT = 'So11111111111111111111111111111111111111112'
+USD_STABLE_MINTS = {'EPjFWdd5AufqSSqeM2qN1xzybapC8G4wEGGkZwyTDt1v', 'Es9vMFrzaCERmJfrF4H2FYD4KCoNkY11McCe8BenwNYB'} # USDC, USDT
+QUOTE_MINTS = {WSOL_MINT} | USD_STABLE_MINTS
+
+# Fonte dos snapshots de mercado: 'dexscreener' ou 'onchain' (reservas das pools Raydium AMM v4 via getMultipleAccounts;
+# pares que não são AMM v4 continuam vindo da DexScreener)
+MARKET_DATA_SOURCE = os.environ.get('MARKET_DATA_SOURCE', 'dexscreener')
+SOL_USD_REFERENCE_POOL = os.environ.get('SOL_USD_REFERENCE_POOL', '58oQChx4yWmvKdwLLZzBi4ChoCc2fqCUWBkwMihLYQo2') # Pool AMM v4 SOL/USDC usada para converter SOL em USD
+GET_MULTIPLE_ACCOUNTS_MAX_KEYS = 100 # Limite de contas por chamada do getMultipleAccounts
+RPC_BATCH_MAX_CALLS = int(os.environ.get('RPC_BATCH_MAX_CALLS', 10)) # Chamadas por POST em lote JSON-RPC
+ACCOUNT_READ_COALESCE_SECONDS = float(os.environ.get('ACCOUNT_READ_COALESCE_MS', 10)) / 1000 # Janela para leituras concorrentes de contas pegarem carona na mesma chamada
+AMM_POOL_CACHE_TTL_SECONDS = 24 * 3600 # Vaults e mints de uma pool não mudam; só as reservas são relidas a cada amostra
+KNOWN_TOKENS_CACHE_SIZE = int(os.environ.get('KNOWN_TOKENS_CACHE_SIZE', 50000)) # Endereços já gravados mantidos em memória
+
+# Motor de coleta: requisições simultâneas e limite de requisições/segundo por host
+COLLECT_CONCURRENCY = int(os.environ.get('COLLECT_CONCURRENCY', 8))
+HOST_RATE_LIMITS = {
+    'api.dexscreener.com': float(os.environ.get('DEXSCREENER_RATE_LIMIT', 4)),
+    'api.geckoterminal.com': float(os.environ.get('GECKOTERMINAL_RATE_LIMIT', 0.5)),
+    'api.gopluslabs.io': float(os.environ.get('GOPLUS_RATE_LIMIT', 1)),
+    urlsplit(RPC_URL or '').hostname: float(os.environ.get('RPC_RATE_LIMIT', 10)),
+}
+DEFAULT_HOST_RATE_LIMIT = 2.0
+# Adaptação AIMD dos limites acima (que funcionam como teto): 429/5xx cortam a taxa do host, cada sucesso a recupera aos poucos
+RATE_LIMIT_DECREASE_FACTOR = float(os.environ.get('RATE_LIMIT_DECREASE_FACTOR', 0.5))
+RATE_LIMIT_INCREASE_FRACTION = float(os.environ.get('RATE_LIMIT_INCREASE_FRACTION', 0.02)) # Fração do teto somada a cada resposta bem-sucedida
+RATE_LIMIT_MIN_FRACTION = 0.05 # A taxa nunca cai abaixo dessa fração do teto
+RATE_LIMIT_MAX_ATTEMPTS = int(os.environ.get('RATE_LIMIT_MAX_ATTEMPTS', 5)) # Tentativas de uma requisição limitada antes de desistir
+RATE_LIMIT_MAX_PAUSE_SECONDS = 120 # Teto para o Retry-After informado pelo servidor
+GOPLUS_BATCH_SIZE = int(os.environ.get('GOPLUS_BATCH_SIZE', 20)) # Endereços por chamada ao token_security da GoPlus
+GOPLUS_PARTIAL_DATA_CODE = 2 # Resposta com dados de só parte dos endereços pedidos
+# Cache dos vereditos da GoPlus: resultados negativos (token sem dados) expiram antes
+SECURITY_CACHE_BACKEND = os.environ.get('SECURITY_CACHE_BACKEND', 'memory') # 'memory' ou 'postgres' (memória + tabela security_cache)
+SECURITY_CACHE_TTL_SECONDS = int(os.environ.get('SECURITY_CACHE_TTL_SECONDS', 6 * 3600))
+SECURITY_CACHE_NEGATIVE_TTL_SECONDS = int(os.environ.get('SECURITY_CACHE_NEGATIVE_TTL_SECONDS', 600))
+SECURITY_CACHE_MAX_ENTRIES = int(os.environ.get('SECURITY_CACHE_MAX_ENTRIES', 10000))
+PROFILE_CONCURRENCY = int(os.environ.get('PROFILE_CONCURRENCY', 8)) # Consultas GoPlus/RPC simultâneas ao perfilar novos tokens
+
+# Sessões HTTP persistentes: conexões keep-alive por provedor e retries para erros transitórios
+HTTP_POOL_SIZES = {
+    'dexscreener': int(os.environ.get('DEXSCREENER_POOL_SIZE', 10)),
+    'geckoterminal': int(os.environ.get('GECKOTERMINAL_POOL_SIZE', 2)),
+    'goplus': int(os.environ.get('GOPLUS_POOL_SIZE', 4)),
+    'helius': int(os.environ.get('RPC_POOL_SIZE', 8)),
+}
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+
+# Pool de conexões PostgreSQL compartilhado por todas as fases
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 5))
+DB_POOL_HEALTH_CHECK_SECONDS = int(os.environ.get('DB_POOL_HEALTH_CHECK_SECONDS', 60)) # Conexões ociosas por mais tempo são testadas antes do uso
+DB_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('DB_CONNECT_TIMEOUT_SECONDS', 10)) # Com o banco fora do ar, a conexão falha em vez de travar a thread
+
+# Particionamento de market_data por intervalo de tempo e política de retenção
+MARKET_DATA_PARTITION_INTERVAL = os.environ.get('MARKET_DATA_PARTITION_INTERVAL', 'day') # 'day' ou 'week'
+MARKET_DATA_PARTITIONS_AHEAD = int(os.environ.get('MARKET_DATA_PARTITIONS_AHEAD', 3)) # Partições futuras criadas antecipadamente
+MARKET_DATA_RETENTION_DAYS = int(os.environ.get('MARKET_DATA_RETENTION_DAYS', 0)) # 0 mantém o histórico para sempre
+MARKET_DATA_RETENTION_MODE = os.environ.get('MARKET_DATA_RETENTION_MODE', 'archive') # 'archive' (move para outro schema) ou 'drop'
+PARTITION_MAINTENANCE_INTERVAL_SECONDS = 3600
+
+# Gravação em lote dos snapshots de mercado: uma transação por flush
+MARKET_DATA_FLUSH_SIZE = int(os.environ.get('MARKET_DATA_FLUSH_SIZE', 500))
+MARKET_DATA_FLUSH_INTERVAL_SECONDS = float(os.environ.get('MARKET_DATA_FLUSH_INTERVAL_SECONDS', 10))
+MARKET_DATA_FLUSH_MAX_BACKOFF_SECONDS = 300 # Após falhas seguidas, o intervalo entre tentativas dobra até esse teto
+MARKET_DATA_BUFFER_MAX_ROWS = int(os.environ.get('MARKET_DATA_BUFFER_MAX_ROWS', 50000)) # Acima disso os snapshots mais antigos são descartados
 
 # --- 2. SERVIDOR WEB PARA HEALTH CHECK ---
 app = Flask(__name__)
 @app.route('/')
 def health_check():
-    return "Data collector is alive and running.", 200
+    # 503 quando algum worker morreu ou parou de dar sinal de vida, para o health check da plataforma reiniciar o container
+    workers = {name: worker.status() for name, worker in WORKERS.items()}
+    queues = {name: worker_queue.qsize() for name, worker_queue in WORKER_QUEUES.items()}
+    healthy = all(status['alive'] for status in workers.values())
+    return jsonify({'status': 'alive' if healthy else 'degraded', 'workers': workers, 'queues': queues}), 200 if healthy else 503
+
+@app.route('/metrics')
+def metrics():
+    sharding = {'mode': SHARDING_MODE, 'replica_id': REPLICA_ID, 'replicas': sampling_scheduler.replicas, 'owned_tokens': len(sampling_scheduler.tokens)}
+    with account_reader.lock: account_reads = dict(account_reader.stats)
+    single_flight = {'goplus': dict(goplus_flight.stats), 'rpc': dict(rpc_flight.stats)}
+    return jsonify({'http_latency': get_http_latency_stats(), 'rate_limits': get_rate_limiter_stats(), 'db_pool': get_db_pool_stats(), 'sharding': sharding,
+                    'discovery': get_discovery_stats(), 'account_reads': account_reads, 'single_flight': single_flight}), 200
 
 def run_web_server():
     port = int(os.environ.get("PORT", 8000))
     app.run(host='0.0.0.0', port=port)
 
 # --- 3. BANCO DE DADOS (PostgreSQL) ---
-def get_db_connection():
-    if not DATABASE_URL: raise ValueError("DATABASE_URL não configurada.")
-    return psycopg2.connect(DATABASE_URL)
+_db_pool = None; _db_pool_slots = None; _db_pool_lock = Lock()
+_db_conn_last_used = {}
+_db_pool_stats = {'checkouts': 0, 'in_use': 0, 'peak_in_use': 0, 'reconnects': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0}
 
-def setup_database():
-    print("🔧 Configurando o banco de dados PostgreSQL...")
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tokens (id SERIAL PRIMARY KEY, token_address TEXT UNIQUE NOT NULL, pair_address TEXT, chain TEXT, symbol TEXT, discovered_at TIMESTAMPTZ, initial_holder_count INTEGER, is_honeypot BOOLEAN, buy_tax REAL, sell_tax REAL, status TEXT DEFAULT 'monitoring', death_at TIMESTAMPTZ, death_reason TEXT);
-    ''')
+def get_db_pool():
+    global _db_pool, _db_pool_slots
+    with _db_pool_lock:
+        if _db_pool is None:
+            if not DATABASE_URL: raise ValueError("DATABASE_URL não configurada.")
+            _db_pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DATABASE_URL, connect_timeout=DB_CONNECT_TIMEOUT_SECONDS)
+            # O ThreadedConnectionPool falha quando esgotado; o semáforo faz a thread esperar por uma vaga
+            _db_pool_slots = BoundedSemaphore(DB_POOL_MAX_SIZE)
+        return _db_pool
+
+def _checkout_healthy_connection(pool):
+    conn = pool.getconn()
+    idle = time.monotonic() - _db_conn_last_used.get(id(conn), 0)
+    if not conn.closed and idle < DB_POOL_HEALTH_CHECK_SECONDS: return conn
+    try:
+        with conn.cursor() as cursor: cursor.execute("SELECT 1")
+        conn.rollback()
+        return conn
+    except psycopg2.Error:
+        pool.putconn(conn, close=True)
+        with _db_pool_lock: _db_pool_stats['reconnects'] += 1
+        return pool.getconn()
+
+@contextmanager
+def db_connection():
+    """Empresta uma conexão do pool. Transações não confirmadas são descartadas na devolução."""
+    pool = get_db_pool()
+    started = time.perf_counter()
+    _db_pool_slots.acquire()
+    wait_ms = (time.perf_counter() - started) * 1000
+    try:
+        conn = _checkout_healthy_connection(pool)
+    except Exception:
+        _db_pool_slots.release(); raise
+    with _db_pool_lock:
+        _db_pool_stats['checkouts'] += 1; _db_pool_stats['in_use'] += 1
+        _db_pool_stats['peak_in_use'] = max(_db_pool_stats['peak_in_use'], _db_pool_stats['in_use'])
+        _db_pool_stats['total_wait_ms'] += wait_ms; _db_pool_stats['max_wait_ms'] = max(_db_pool_stats['max_wait_ms'], wait_ms)
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True; raise
+    finally:
+        if not conn.closed and not broken:
+            try: conn.rollback()
+            except psycopg2.Error: broken = True
+        _db_conn_last_used[id(conn)] = time.monotonic()
+        pool.putconn(conn, close=broken or conn.closed)
+        with _db_pool_lock: _db_pool_stats['in_use'] -= 1
+        _db_pool_slots.release()
+
+def get_db_pool_stats():
+    with _db_pool_lock:
+        checkouts = _db_pool_stats['checkouts']
+        return {**_db_pool_stats, 'max_size': DB_POOL_MAX_SIZE, 'utilisation': round(_db_pool_stats['in_use'] / DB_POOL_MAX_SIZE, 2),
+                'avg_wait_ms': round(_db_pool_stats['total_wait_ms'] / checkouts, 2) if checkouts else 0.0}
+
+def partition_period(moment, interval=MARKET_DATA_PARTITION_INTERVAL):
+    """Retorna o início (UTC) do período de partição que contém `moment`."""
+    start = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return start - timedelta(days=start.weekday()) if interval == 'week' else start
+
+def partition_step(interval=MARKET_DATA_PARTITION_INTERVAL):
+    return timedelta(weeks=1) if interval == 'week' else timedelta(days=1)
+
+def partition_name(period_start, interval=MARKET_DATA_PARTITION_INTERVAL):
+    return f"market_data_{'w' if interval == 'week' else 'p'}{period_start:%Y%m%d}"
+
+def _partition_market_data(cursor):
+    # A tabela antiga vira a partição "legacy" (até o próximo período) e as novas linhas vão para partições por período
+    boundary = partition_period(datetime.now(timezone.utc)) + partition_step()
+    cursor.execute("ALTER TABLE market_data RENAME TO market_data_legacy")
+    # A chave primária de uma tabela particionada precisa incluir a coluna de partição; o ATTACH recria (id, timestamp)
+    cursor.execute("ALTER TABLE market_data_legacy DROP CONSTRAINT market_data_pkey")
+    cursor.execute("ALTER INDEX idx_market_data_token_time RENAME TO market_data_legacy_token_time_idx")
+    cursor.execute("CREATE TABLE market_data (id INTEGER NOT NULL DEFAULT nextval('market_data_id_seq'), token_id INTEGER REFERENCES tokens(id), timestamp TIMESTAMPTZ NOT NULL, price_usd NUMERIC, liquidity_usd NUMERIC, volume_h1 NUMERIC, buys_h1 INTEGER, sells_h1 INTEGER, PRIMARY KEY (id, timestamp)) PARTITION BY RANGE (timestamp)")
+    cursor.execute("ALTER TABLE market_data ATTACH PARTITION market_data_legacy FOR VALUES FROM (MINVALUE) TO (%s)", (boundary,))
+    cursor.execute("CREATE INDEX idx_market_data_token_time ON market_data (token_id, timestamp DESC)")
+    # Rede de segurança: linhas fora das partições criadas não fazem o INSERT falhar
+    cursor.execute("CREATE TABLE market_data_default PARTITION OF market_data DEFAULT")
+
+def _create_market_data_partition(cursor, name, period):
+    """Cria a partição do período; retorna quantas linhas dele foram retiradas da partição default."""
+    period_end = period + partition_step()
+    cursor.execute("SELECT count(*) FROM market_data_default WHERE timestamp >= %s AND timestamp < %s", (period, period_end))
+    stray_rows = cursor.fetchone()[0]
+    if not stray_rows:
+        cursor.execute(f"CREATE TABLE {name} PARTITION OF market_data FOR VALUES FROM (%s) TO (%s)", (period, period_end))
+        return 0
+    # Com linhas do período na default o CREATE ... PARTITION OF falharia: cria a tabela solta, move as linhas e anexa
+    cursor.execute(f"CREATE TABLE {name} (LIKE market_data INCLUDING DEFAULTS)")
+    cursor.execute(f"WITH moved AS (DELETE FROM market_data_default WHERE timestamp >= %s AND timestamp < %s RETURNING *) INSERT INTO {name} SELECT * FROM moved", (period, period_end))
+    cursor.execute(f"ALTER TABLE market_data ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (period, period_end))
+    return stray_rows
+
+def _market_data_partition_bounds(cursor):
+    """Retorna [(nome, início, fim)] das partições por intervalo de market_data (a legacy começa em MINVALUE, início None); a default fica de fora."""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS market_data (id SERIAL PRIMARY KEY, token_id INTEGER REFERENCES tokens(id), timestamp TIMESTAMPTZ NOT NULL, price_usd NUMERIC, liquidity_usd NUMERIC, volume_h1 NUMERIC, buys_h1 INTEGER, sells_h1 INTEGER);
+        SELECT child.relname,
+               substring(pg_get_expr(child.relpartbound, child.oid) FROM 'FROM \\(''([^'']+)''\\)')::timestamptz,
+               substring(pg_get_expr(child.relpartbound, child.oid) FROM 'TO \\(''([^'']+)''\\)')::timestamptz
+        FROM pg_inherits JOIN pg_class parent ON parent.oid = inhparent JOIN pg_class child ON child.oid = inhrelid
+        WHERE parent.relname = 'market_data' AND pg_get_expr(child.relpartbound, child.oid) <> 'DEFAULT'
     ''')
+    return cursor.fetchall()
+
+def maintain_market_data_partitions(conn):
+    """Cria as partições futuras de market_data (e as de períodos com linhas caídas na default, movendo-as)
+    e aplica a retenção desanexando partições antigas."""
+    created = []; retired = []
+    with conn.cursor() as cursor:
+        current = partition_period(datetime.now(timezone.utc))
+        periods = {current + partition_step() * ahead for ahead in range(MARKET_DATA_PARTITIONS_AHEAD + 1)}
+        # Linhas gravadas quando o período ainda não tinha partição caem na default; o período delas ganha a sua
+        cursor.execute("SELECT DISTINCT date_trunc('day', timestamp AT TIME ZONE 'UTC') FROM market_data_default")
+        periods.update(partition_period(day.replace(tzinfo=timezone.utc)) for (day,) in cursor.fetchall())
+        bounds = _market_data_partition_bounds(cursor)
+        for period in sorted(periods):
+            name = partition_name(period)
+            # Períodos já cobertos por outra partição (a legacy, até o limite dela, ou outro intervalo configurado) não são recriados
+            if any((start is None or start < period + partition_step()) and end > period for _, start, end in bounds): continue
+            cursor.execute("SELECT to_regclass(%s)", (name,))
+            if cursor.fetchone()[0] is None:
+                cursor.execute("SAVEPOINT create_partition")
+                try:
+                    moved = _create_market_data_partition(cursor, name, period)
+                    cursor.execute("RELEASE SAVEPOINT create_partition"); created.append(name)
+                    if moved: print(f"  - {moved} linha(s) movida(s) da market_data_default para {name}.")
+                except psycopg2.Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT create_partition")
+                    print(f"  - Partição {name} não criada: {str(e).splitlines()[0]}")
+
+        cursor.execute("SELECT count(*) FROM market_data_default")
+        stray_rows = cursor.fetchone()[0]
+        if stray_rows: print(f"⚠️ ALERTA: {stray_rows} linha(s) continuam em market_data_default, fora da retenção; verifique as partições acima.")
+
+        if MARKET_DATA_RETENTION_DAYS > 0:
+            cutoff = datetime.now(timezone.utc) - timedelta(days=MARKET_DATA_RETENTION_DAYS)
+            # O limite superior vem do próprio catálogo, então a legacy também é retirada quando todo o seu intervalo expira
+            for name, _, period_end in _market_data_partition_bounds(cursor):
+                if period_end > cutoff: continue
+                # DETACH + DROP/SET SCHEMA descarta o período inteiro sem o inchaço de um DELETE
+                cursor.execute(f"ALTER TABLE market_data DETACH PARTITION {name}")
+                if MARKET_DATA_RETENTION_MODE == 'drop':
+                    cursor.execute(f"DROP TABLE {name}")
+                else:
+                    cursor.execute("CREATE SCHEMA IF NOT EXISTS market_data_archive")
+                    cursor.execute(f"ALTER TABLE {name} SET SCHEMA market_data_archive")
+                retired.append(name)
     conn.commit()
-    cursor.close()
-    conn.close()
-    print("✅ Banco de dados pronto.")
+    if created or retired: print(f"  - Partições de market_data: {len(created)} criada(s), {len(retired)} retirada(s) ({MARKET_DATA_RETENTION_MODE}).")
+    return created, retired
+
+_last_partition_maintenance = None
+def maintain_partitions_if_due():
+    global _last_partition_maintenance
+    if _last_partition_maintenance is not None and time.monotonic() - _last_partition_maintenance < PARTITION_MAINTENANCE_INTERVAL_SECONDS: return
+    try:
+        with db_connection() as conn: maintain_market_data_partitions(conn)
+        _last_partition_maintenance = time.monotonic()
+    except Exception as e:
+        print(f"Erro na manutenção das partições: {e}")
+
+# Migrações versionadas do schema: (versão, descrição, comandos SQL ou funções que recebem o cursor).
+# Nunca altere uma migração já aplicada; acrescente uma nova.
+SCHEMA_MIGRATIONS = [
+    (1, "tabelas iniciais tokens e market_data", [
+        "CREATE TABLE IF NOT EXISTS tokens (id SERIAL PRIMARY KEY, token_address TEXT UNIQUE NOT NULL, pair_address TEXT, chain TEXT, symbol TEXT, discovered_at TIMESTAMPTZ, initial_holder_count INTEGER, is_honeypot BOOLEAN, buy_tax REAL, sell_tax REAL, status TEXT DEFAULT 'monitoring', death_at TIMESTAMPTZ, death_reason TEXT)",
+        "CREATE TABLE IF NOT EXISTS market_data (id SERIAL PRIMARY KEY, token_id INTEGER REFERENCES tokens(id), timestamp TIMESTAMPTZ NOT NULL, price_usd NUMERIC, liquidity_usd NUMERIC, volume_h1 NUMERIC, buys_h1 INTEGER, sells_h1 INTEGER)",
+    ]),
+    (2, "índices para tokens monitorados e séries temporais", [
+        # Índice parcial: só os tokens em monitoramento, que é o que a coleta lê a cada ciclo
+        "CREATE INDEX IF NOT EXISTS idx_tokens_monitoring ON tokens (id) INCLUDE (pair_address, symbol) WHERE status = 'monitoring'",
+        "CREATE INDEX IF NOT EXISTS idx_market_data_token_time ON market_data (token_id, timestamp DESC)",
+    ]),
+    (3, "particionamento de market_data por intervalo de tempo", [_partition_market_data]),
+    (4, "cache persistente dos vereditos da GoPlus", [
+        "CREATE TABLE IF NOT EXISTS security_cache (token_address TEXT PRIMARY KEY, result JSONB, expires_at TIMESTAMPTZ NOT NULL)",
+    ]),
+    (5, "registro de réplicas para o sharding da coleta", [
+        "CREATE TABLE IF NOT EXISTS collector_replicas (replica_id TEXT PRIMARY KEY, heartbeat_at TIMESTAMPTZ NOT NULL)",
+    ]),
+    (6, "fonte e horário de criação do par que descobriram cada token", [
+        "ALTER TABLE tokens ADD COLUMN IF NOT EXISTS discovery_source TEXT, ADD COLUMN IF NOT EXISTS pair_created_at TIMESTAMPTZ",
+    ]),
+    (7, "marca d'água (último par visto) de cada fonte de descoberta paginada", [
+        "CREATE TABLE IF NOT EXISTS discovery_cursors (source TEXT PRIMARY KEY, last_seen_at TIMESTAMPTZ, last_seen_pair TEXT, updated_at TIMESTAMPTZ NOT NULL DEFAULT now())",
+    ]),
+    (8, "horário do perfilamento de cada token, para reenfileirar os que ficaram sem perfil", [
+        "ALTER TABLE tokens ADD COLUMN IF NOT EXISTS profiled_at TIMESTAMPTZ",
+        # Linhas gravadas pelo fluxo antigo (perfil antes do INSERT) já foram perfiladas
+        "UPDATE tokens SET profiled_at = discovered_at WHERE profiled_at IS NULL AND (initial_holder_count IS NOT NULL OR is_honeypot IS NOT NULL OR buy_tax IS NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS idx_tokens_unprofiled ON tokens (discovered_at) WHERE profiled_at IS NULL",
+    ]),
+]
+MIGRATIONS_LOCK_KEY = 7710001 # Chave do advisory lock que serializa migrações entre réplicas
+DISCOVERY_LEADER_LOCK_KEY = 7710002 # Chave do advisory lock que elege a réplica líder da descoberta
+
+def apply_migrations(conn):
+    """Aplica, em ordem, as migrações ainda não registradas em schema_migrations (uma transação por versão)."""
+    with conn.cursor() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+        conn.commit()
+        for version, description, statements in SCHEMA_MIGRATIONS:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+            cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cursor.fetchone():
+                conn.rollback(); continue
+            print(f"  - Aplicando migração {version}: {description}")
+            for statement in statements:
+                if callable(statement): statement(cursor)
+                else: cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+            conn.commit()
+        cursor.execute("SELECT max(version) FROM schema_migrations")
+        return cursor.fetchone()[0]
+
+def setup_database():
+    print("🔧 Configurando o banco de dados PostgreSQL...")
+    with db_connection() as conn:
+        schema_version = apply_migrations(conn)
+    maintain_partitions_if_due()
+    print(f"✅ Banco de dados pronto (schema versão {schema_version}).")
+
+class MarketDataWriter:
+    """Acumula snapshots e marcações de 'morte' e grava tudo com execute_values, em uma transação por flush."""
+    def __init__(self, flush_size=MARKET_DATA_FLUSH_SIZE, flush_interval=MARKET_DATA_FLUSH_INTERVAL_SECONDS, max_rows=MARKET_DATA_BUFFER_MAX_ROWS):
+        self.flush_size = flush_size; self.flush_interval = flush_interval; self.max_rows = max_rows
+        self.snapshots = []; self.deaths = []; self.lock = Lock(); self.last_flush = time.monotonic()
+        self.failures = 0 # Flushes seguidos que falharam; enquanto > 0 o buffer cheio não dispara novas tentativas
+        self.dropped = 0 # Snapshots descartados pelo limite do buffer desde o último aviso
+
+    def add_snapshot(self, token_id, timestamp, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1):
+        with self.lock:
+            self.snapshots.append((token_id, timestamp, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1))
+            self._trim()
+        self.flush_if_due()
+
+    def _trim(self):
+        # Chamado com o lock: num banco fora do ar por muito tempo, mantém só os snapshots mais recentes
+        overflow = len(self.snapshots) - self.max_rows
+        if overflow > 0:
+            del self.snapshots[:overflow]; self.dropped += overflow
+
+    def mark_dead(self, token_id, death_at, death_reason):
+        with self.lock: self.deaths.append((token_id, death_at, death_reason))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.last_flush
+            if self.failures: due = elapsed >= min(self.flush_interval * 2 ** self.failures, MARKET_DATA_FLUSH_MAX_BACKOFF_SECONDS)
+            else: due = len(self.snapshots) >= self.flush_size or elapsed >= self.flush_interval
+        if due: self.flush()
+
+    def flush(self):
+        with self.lock:
+            snapshots, deaths, dropped = self.snapshots, self.deaths, self.dropped
+            self.snapshots = []; self.deaths = []; self.dropped = 0; self.last_flush = time.monotonic()
+        if dropped: print(f"⚠️ Buffer de market_data cheio: {dropped} snapshot(s) mais antigo(s) descartado(s).")
+        if not snapshots and not deaths: return 0
+        try:
+            with db_connection() as conn, conn.cursor() as cursor:
+                psycopg2.extras.execute_values(cursor, "INSERT INTO market_data (token_id, timestamp, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1) VALUES %s", snapshots, page_size=1000)
+                psycopg2.extras.execute_values(cursor, "UPDATE tokens SET status = 'dead', death_at = v.death_at, death_reason = v.death_reason FROM (VALUES %s) AS v (id, death_at, death_reason) WHERE tokens.id = v.id", deaths)
+                conn.commit()
+        except Exception as e:
+            # Devolve as linhas ao buffer para a próxima tentativa em vez de perdê-las
+            print(f"Erro ao gravar {len(snapshots)} snapshot(s): {e}")
+            with self.lock:
+                self.snapshots[:0] = snapshots; self.deaths[:0] = deaths
+                self.failures += 1; self._trim()
+            return 0
+        with self.lock: self.failures = 0
+        return len(snapshots)
+
+market_data_writer = MarketDataWriter()
+
+class KnownTokenCache:
+    """Conjunto limitado (LRU) de endereços que já existem em `tokens`, para evitar idas ao banco a cada ciclo."""
+    def __init__(self, max_size=KNOWN_TOKENS_CACHE_SIZE):
+        self.max_size = max_size; self.addresses = OrderedDict(); self.lock = Lock()
+
+    def __contains__(self, token_address):
+        with self.lock:
+            if token_address not in self.addresses: return False
+            self.addresses.move_to_end(token_address)
+            return True
+
+    def add(self, token_addresses):
+        with self.lock:
+            for token_address in token_addresses:
+                self.addresses[token_address] = True; self.addresses.move_to_end(token_address)
+            while len(self.addresses) > self.max_size: self.addresses.popitem(last=False)
+
+known_tokens = KnownTokenCache()
 
 # --- 4. FONTES DE DADOS (APIs) ---
-def get_security_data(token_address):
-    if not GOPLUS_API_KEY: return None
-    url = f"https://api.gopluslabs.io/api/v1/token_security/{GOPLUS_CHAIN_ID}?contract_addresses={token_address}"
-    headers = {'X-API-KEY': GOPLUS_API_KEY}
+_http_sessions = {}; _http_sessions_lock = Lock()
+_http_latency = {}; _http_latency_lock = Lock()
+
+def get_http_session(provider):
+    """Retorna a sessão persistente do provedor, reaproveitando conexões TCP/TLS entre chamadas."""
+    with _http_sessions_lock:
+        if provider not in _http_sessions:
+            # Retries apenas para falhas de rede; 429/5xx ficam com o limitador adaptativo em http_request
+            retry = Retry(total=HTTP_MAX_RETRIES, backoff_factor=0.5, status_forcelist=(), allowed_methods=None, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZES.get(provider, 4), max_retries=retry)
+            session = requests.Session(); session.mount('https://', adapter); session.mount('http://', adapter)
+            _http_sessions[provider] = session
+        return _http_sessions[provider]
+
+def record_http_latency(host, elapsed, failed=False):
+    with _http_latency_lock:
+        stats = _http_latency.setdefault(host, {'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['requests'] += 1; stats['total_ms'] += elapsed * 1000; stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+        if failed: stats['errors'] += 1
+
+def get_http_latency_stats():
+    with _http_latency_lock:
+        return {host: {**stats, 'avg_ms': round(stats['total_ms'] / stats['requests'], 1)} for host, stats in _http_latency.items()}
+
+def print_http_latency_report():
+    for host, stats in get_http_latency_stats().items():
+        print(f"  - {host}: {stats['requests']} req, média {stats['avg_ms']:.0f} ms, máx {stats['max_ms']:.0f} ms, {stats['errors']} erro(s)")
+
+def is_throttled_status(status_code):
+    return status_code == 429 or status_code >= 500
+
+def parse_retry_after(value):
+    """Segundos pedidos pelo cabeçalho Retry-After (número ou data HTTP), limitados a RATE_LIMIT_MAX_PAUSE_SECONDS."""
+    if not value: return None
+    try: seconds = float(value)
+    except ValueError:
+        try: seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError): return None
+    return min(max(seconds, 0.0), RATE_LIMIT_MAX_PAUSE_SECONDS)
+
+def http_request(provider, method, url, **kwargs):
+    """Faz a requisição pela sessão do provedor, respeitando o limite do host, e registra a latência.
+    Um 429/5xx reduz a taxa do host e a requisição volta para a fila do limitador, até RATE_LIMIT_MAX_ATTEMPTS vezes."""
+    host = urlsplit(url).hostname; limiter = get_rate_limiter(host)
+    for attempt in range(1, RATE_LIMIT_MAX_ATTEMPTS + 1):
+        limiter.acquire()
+        started = time.perf_counter(); failed = True
+        try:
+            response = get_http_session(provider).request(method, url, **kwargs)
+            failed = response.status_code >= 400
+        finally:
+            record_http_latency(host, time.perf_counter() - started, failed)
+        if not is_throttled_status(response.status_code):
+            limiter.on_success(); return response
+        limiter.on_throttle(parse_retry_after(response.headers.get('Retry-After')))
+        if attempt < RATE_LIMIT_MAX_ATTEMPTS: response.close()
+    return response
+
+class TTLCache:
+    """Cache em memória com expiração por entrada e limite LRU. `get` devolve MISSING quando não há entrada válida."""
+    MISSING = object()
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries; self.entries = OrderedDict(); self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None: return self.MISSING
+            value, expires_at = entry
+            if expires_at <= time.time():
+                del self.entries[key]; return self.MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl); self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+security_cache = TTLCache(SECURITY_CACHE_MAX_ENTRIES)
+
+class SingleFlight:
+    """Deduplica buscas concorrentes pela mesma chave: a primeira thread busca e as demais esperam o mesmo Future,
+    recebendo o resultado (ou a exceção) dela. Nada fica guardado depois que a busca termina; cache é papel do chamador."""
+    def __init__(self):
+        self.in_flight = {}; self.lock = Lock(); self.stats = {'fetched': 0, 'shared': 0}
+
+    def do(self, key, fetch):
+        return self.do_many([key], lambda keys: {key: fetch()})[key]
+
+    def do_many(self, keys, fetch):
+        """`fetch(chaves)` recebe só as chaves que ninguém está buscando e retorna {chave: resultado}."""
+        owned = {}; waiting = {}
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                if key in self.in_flight: waiting[key] = self.in_flight[key]
+                else: owned[key] = self.in_flight[key] = Future()
+            self.stats['fetched'] += len(owned); self.stats['shared'] += len(waiting)
+        if owned:
+            try:
+                results = fetch(list(owned))
+                for key, future in owned.items(): future.set_result(results.get(key))
+            except Exception as e:
+                for future in owned.values(): future.set_exception(e)
+            finally:
+                with self.lock:
+                    for key in owned: del self.in_flight[key]
+        return {key: (owned.get(key) or waiting[key]).result() for key in keys}
+
+# Resultado de uma consulta que falhou (rate limit esgotado, erro HTTP/RPC), distinto de "sem dados"; o token é perfilado de novo depois
+LOOKUP_FAILED = object()
+
+goplus_flight = SingleFlight() # Por endereço consultado na GoPlus
+rpc_flight = SingleFlight() # Por (método, params) de chamada JSON-RPC
+
+def _load_cached_security(token_addresses):
+    cached = {}
+    for address in token_addresses:
+        value = security_cache.get(address)
+        if value is not TTLCache.MISSING: cached[address] = value
+    missing = [address for address in token_addresses if address not in cached]
+    if missing and SECURITY_CACHE_BACKEND == 'postgres':
+        try:
+            with db_connection() as conn, conn.cursor() as cursor:
+                cursor.execute("SELECT token_address, result, extract(epoch FROM expires_at - now()) FROM security_cache WHERE token_address = ANY(%s) AND expires_at > now()", (missing,))
+                for address, result, ttl in cursor.fetchall():
+                    cached[address] = result; security_cache.set(address, result, float(ttl))
+        except Exception as e:
+            print(f"  - Erro ao ler o cache de segurança: {e}")
+    return cached
+
+def _store_cached_security(verdicts):
+    for address, result in verdicts.items():
+        security_cache.set(address, result, SECURITY_CACHE_TTL_SECONDS if result else SECURITY_CACHE_NEGATIVE_TTL_SECONDS)
+    if not verdicts or SECURITY_CACHE_BACKEND != 'postgres': return
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        result_dict = response.json().get('result')
-        if result_dict: return result_dict.get(token_address)
-        return None
-    except requests.RequestException as e:
-        print(f"  - Erro na API GoPlus: {e}")
-        return None
+        with db_connection() as conn, conn.cursor() as cursor:
+            rows = [(address, psycopg2.extras.Json(result) if result else None, SECURITY_CACHE_TTL_SECONDS if result else SECURITY_CACHE_NEGATIVE_TTL_SECONDS) for address, result in verdicts.items()]
+            psycopg2.extras.execute_values(cursor, "INSERT INTO security_cache (token_address, result, expires_at) VALUES %s ON CONFLICT (token_address) DO UPDATE SET result = EXCLUDED.result, expires_at = EXCLUDED.expires_at", rows, template="(%s, %s, now() + make_interval(secs => %s))")
+            conn.commit()
+    except Exception as e:
+        print(f"  - Erro ao gravar o cache de segurança: {e}")
+
+def _match_security_results(result_dict, token_addresses):
+    # A GoPlus pode devolver as chaves em minúsculas; tenta o endereço exato e depois a forma minúscula
+    lowered = {key.lower(): value for key, value in result_dict.items()}
+    return {address: result_dict.get(address) or lowered.get(address.lower()) for address in token_addresses}
+
+def get_security_data_batch(token_addresses):
+    """Busca a segurança de vários tokens (cache primeiro, depois GoPlus em lotes de GOPLUS_BATCH_SIZE); ausentes ficam como None
+    e os de lotes que falharam como LOOKUP_FAILED."""
+    results = dict.fromkeys(token_addresses)
+    if not GOPLUS_API_KEY: return results
+    cached = _load_cached_security(token_addresses)
+    results.update(cached)
+    pending = [address for address in token_addresses if address not in cached]
+    # Endereços já em consulta por outra thread não geram uma segunda chamada
+    if pending: results.update(goplus_flight.do_many(pending, _fetch_goplus_security))
+    return results
+
+def _fetch_goplus_security(pending):
+    results = {}
+    headers = {'X-API-KEY': GOPLUS_API_KEY}
+    for start in range(0, len(pending), GOPLUS_BATCH_SIZE):
+        chunk = pending[start:start + GOPLUS_BATCH_SIZE]
+        url = f"https://api.gopluslabs.io/api/v1/token_security/{GOPLUS_CHAIN_ID}?contract_addresses={','.join(chunk)}"
+        try:
+            response = http_request('goplus', 'GET', url, headers=headers, timeout=10)
+            response.raise_for_status()
+            payload = response.json()
+            code = payload.get('code', 1)
+            # code=2: dados parciais; os vereditos presentes valem, os ausentes não são cacheados para serem consultados de novo
+            if code not in (1, GOPLUS_PARTIAL_DATA_CODE): raise requests.RequestException(f"GoPlus respondeu code={code}: {payload.get('message')}")
+            # Só respostas válidas entram no cache; tokens ausentes nelas viram resultado negativo com TTL curto
+            verdicts = _match_security_results(payload.get('result') or {}, chunk)
+            results.update(verdicts)
+            _store_cached_security(verdicts if code == 1 else {address: result for address, result in verdicts.items() if result})
+        except requests.RequestException as e:
+            print(f"  - Erro na API GoPlus ({len(chunk)} endereço(s)): {e}")
+            results.update(dict.fromkeys(chunk, LOOKUP_FAILED))
+    return results
+
+def get_security_data(token_address):
+    return get_security_data_batch([token_address])[token_address]
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+_B58_INDEX = {char: index for index, char in enumerate(B58_ALPHABET)}
+
+def b58encode(data):
+    number = int.from_bytes(data, 'big'); encoded = ''
+    while number:
+        number, remainder = divmod(number, 58); encoded = B58_ALPHABET[remainder] + encoded
+    leading_zeros = next((index for index, byte in enumerate(data) if byte), len(data))
+    return '1' * leading_zeros + encoded
+
+def b58decode(value):
+    number = 0
+    for char in value: number = number * 58 + _B58_INDEX[char]
+    leading_zeros = len(value) - len(value.lstrip('1'))
+    return b'\0' * leading_zeros + number.to_bytes((number.bit_length() + 7) // 8, 'big')
+
+def _rpc_call(method, params, timeout):
+    # Chamadas idênticas simultâneas (mesmo método e params) compartilham uma única requisição
+    return rpc_flight.do((method, json.dumps(params, sort_keys=True)), lambda: _post_rpc(method, params, timeout))
+
+def _post_rpc(method, params, timeout):
+    headers = {'Content-Type': 'application/json'}
+    payload = {"jsonrpc": "2.0", "id": 1, "method": method, "params": params}
+    response = http_request('helius', 'POST', RPC_URL, headers=headers, json=payload, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if 'error' in data: raise ValueError(f"{method}: {data['error']}")
+    return data.get('result')
+
+def _rpc_batch_call(calls, timeout):
+    """Envia as chamadas (método, params) num único POST, como lote JSON-RPC, e retorna os resultados na mesma ordem."""
+    headers = {'Content-Type': 'application/json'}
+    payload = [{"jsonrpc": "2.0", "id": index, "method": method, "params": params} for index, (method, params) in enumerate(calls)]
+    # O provedor cobra cada chamada do lote; as fichas além da primeira (que http_request consome) são pegas aqui
+    limiter = get_rate_limiter(urlsplit(RPC_URL).hostname)
+    for _ in range(len(calls) - 1): limiter.acquire()
+    response = http_request('helius', 'POST', RPC_URL, headers=headers, json=payload, timeout=timeout)
+    response.raise_for_status()
+    data = response.json()
+    if not isinstance(data, list): raise ValueError(f"lote JSON-RPC recusado: {data.get('error', data)}")
+    replies = {reply.get('id'): reply for reply in data}
+    results = []
+    for index, (method, _) in enumerate(calls):
+        reply = replies.get(index, {'error': 'sem resposta no lote'})
+        if 'error' in reply: raise ValueError(f"{method}: {reply['error']}")
+        results.append(reply.get('result'))
+    return results
+
+# Contas lidas do RPC: `data` é um memoryview sobre os bytes decodificados do base64, fatiado sem cópias pelos decodificadores
+RawAccount = namedtuple('RawAccount', 'owner lamports data')
+SplTokenAccount = namedtuple('SplTokenAccount', 'mint owner amount state')
+_SPL_TOKEN_ACCOUNT_LAYOUT = struct.Struct('<32s32sQ') # mint, owner, amount; o estado fica no offset 108
+SPL_TOKEN_ACCOUNT_STATE_OFFSET = 108
+
+def decode_spl_token_account(data):
+    mint, owner, amount = _SPL_TOKEN_ACCOUNT_LAYOUT.unpack_from(data)
+    return SplTokenAccount(b58encode(mint), b58encode(owner), amount, data[SPL_TOKEN_ACCOUNT_STATE_OFFSET])
+
+class AccountReader:
+    """Agrupa as leituras de contas de todas as threads: quem chega primeiro espera ACCOUNT_READ_COALESCE_SECONDS,
+    recolhe as chaves pendentes e as lê em getMultipleAccounts de até 100 chaves, várias por POST (lote JSON-RPC).
+    Chaves já pendentes compartilham o mesmo resultado."""
+    def __init__(self, window=ACCOUNT_READ_COALESCE_SECONDS):
+        self.window = window; self.pending = {}; self.flushing = False; self.lock = Lock()
+        self.stats = {'requested_keys': 0, 'fetched_keys': 0, 'posts': 0}
+
+    def get_accounts(self, pubkeys):
+        """Retorna {pubkey: RawAccount ou None}."""
+        with self.lock:
+            futures = {pubkey: self.pending.setdefault(pubkey, Future()) for pubkey in pubkeys}
+            self.stats['requested_keys'] += len(futures)
+            leader = not self.flushing; self.flushing = True
+        if leader:
+            time.sleep(self.window)
+            self._flush()
+        return {pubkey: future.result() for pubkey, future in futures.items()}
+
+    def _flush(self):
+        with self.lock:
+            batch = self.pending; self.pending = {}; self.flushing = False
+        keys = list(batch)
+        chunks = [keys[start:start + GET_MULTIPLE_ACCOUNTS_MAX_KEYS] for start in range(0, len(keys), GET_MULTIPLE_ACCOUNTS_MAX_KEYS)]
+        for start in range(0, len(chunks), RPC_BATCH_MAX_CALLS):
+            posted = chunks[start:start + RPC_BATCH_MAX_CALLS]
+            try:
+                results = _rpc_batch_call([('getMultipleAccounts', [chunk, {'encoding': 'base64', 'commitment': 'confirmed'}]) for chunk in posted], timeout=15)
+                with self.lock: self.stats['posts'] += 1; self.stats['fetched_keys'] += sum(len(chunk) for chunk in posted)
+                for chunk, result in zip(posted, results):
+                    for pubkey, account in zip(chunk, result['value']):
+                        batch[pubkey].set_result(RawAccount(account['owner'], account['lamports'], memoryview(base64.b64decode(account['data'][0]))) if account else None)
+            except Exception as e:
+                for chunk in posted:
+                    for pubkey in chunk:
+                        if not batch[pubkey].done(): batch[pubkey].set_exception(e)
+        # Nenhuma thread pode ficar esperando por uma chave sem resposta (ex.: `value` mais curto que o pedido)
+        unanswered = [future for future in batch.values() if not future.done()]
+        for future in unanswered: future.set_exception(ValueError(f"getMultipleAccounts não retornou {len(unanswered)} conta(s) pedida(s)"))
+
+account_reader = AccountReader()
+
+def _count_holders_with_data_slice(token_address):
+    # Baixa só os 8 bytes do campo `amount` (offset 64) de cada conta de 165 bytes, em vez da conta inteira
+    params = [SPL_TOKEN_PROGRAM_ID, {"encoding": "base64", "dataSlice": {"offset": 64, "length": 8}, "filters": [{"dataSize": 165}, {"memcmp": {"offset": 0, "bytes": token_address}}], "withContext": False}]
+    accounts = _rpc_call("getProgramAccounts", params, timeout=60)
+    if not isinstance(accounts, list): raise ValueError("resposta inesperada do getProgramAccounts")
+    return sum(1 for account in accounts if struct.unpack('<Q', base64.b64decode(account['account']['data'][0]))[0] > 0)
+
+def _count_holders_with_das(token_address):
+    # DAS getTokenAccounts paginado; showZeroBalance=False deixa as contas zeradas de fora já no servidor
+    holder_count = 0; page = 1
+    while True:
+        result = _rpc_call("getTokenAccounts", {"mint": token_address, "page": page, "limit": HOLDER_COUNT_PAGE_SIZE, "options": {"showZeroBalance": False}}, timeout=30)
+        page_count = len((result or {}).get('token_accounts') or [])
+        holder_count += page_count
+        if page_count < HOLDER_COUNT_PAGE_SIZE: return holder_count
+        page += 1
 
 def get_holder_count(token_address):
+    """Conta as contas de token com saldo positivo do mint, conforme HOLDER_COUNT_STRATEGY; LOOKUP_FAILED se a chamada falhar."""
     if not RPC_URL:
         print("  - URL RPC não configurada.")
         return 0
     try:
-        headers = {'Content-Type': 'application/json'}
-        payload = { "jsonrpc": "2.0", "id": 1, "method": "getProgramAccounts", "params": ["TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA", {"encoding": "base64", "filters": [{"dataSize": 165}, {"memcmp": {"offset": 0, "bytes": token_address}}], "withContext": False}] }
-        response = requests.post(RPC_URL, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        data = response.json()
-        if 'result' in data and isinstance(data['result'], list):
-            return len(data['result'])
-        else:
-            print(f"  - Resposta inesperada da RPC para holders do token {token_address[:10]}...")
-            return 0
+        if HOLDER_COUNT_STRATEGY == 'das': return _count_holders_with_das(token_address)
+        return _count_holders_with_data_slice(token_address)
     except Exception as e:
-        print(f"  - Erro na chamada RPC para getProgramAccounts: {e}")
-        return 0
+        print(f"  - Erro na chamada RPC para contagem de holders do token {token_address[:10]}...: {e}")
+        return LOOKUP_FAILED
+
+# Conta de estado da Raydium AMM v4 (752 bytes): decimais em 32, PnL pendente em 192, vaults e mints a partir de 336
+AMM_V4_STATE_SIZE = 752
+AmmPool = namedtuple('AmmPool', 'base_vault quote_vault base_mint quote_mint base_decimals quote_decimals')
+amm_pool_cache = TTLCache(KNOWN_TOKENS_CACHE_SIZE)
+
+def decode_amm_v4_pool(account):
+    """AmmPool com as partes fixas da pool, ou None se a conta não for uma pool AMM v4."""
+    if account is None or account.owner != RAYDIUM_AMM_V4_PROGRAM_ID or len(account.data) != AMM_V4_STATE_SIZE: return None
+    data = account.data
+    base_decimals, quote_decimals = struct.unpack_from('<QQ', data, 32)
+    base_vault, quote_vault, base_mint, quote_mint = (b58encode(data[offset:offset + 32]) for offset in range(336, 464, 32))
+    return AmmPool(base_vault, quote_vault, base_mint, quote_mint, base_decimals, quote_decimals)
 
-# --- 5. LÓGICA DO BOT ---
+def _amm_v4_reserves(pool, accounts, pair_address):
+    """(mint do token, reserva do token, mint de cotação, reserva de cotação), já em unidades do token;
+    None se as vaults não forem contas de token dos mints da pool."""
+    base_vault = decode_spl_token_account(accounts[pool.base_vault].data); quote_vault = decode_spl_token_account(accounts[pool.quote_vault].data)
+    if base_vault.mint != pool.base_mint or quote_vault.mint != pool.quote_mint: return None
+    base_need_take_pnl, quote_need_take_pnl = struct.unpack_from('<QQ', accounts[pair_address].data, 192)
+    base_amount = (base_vault.amount - base_need_take_pnl) / 10 ** pool.base_decimals
+    quote_amount = (quote_vault.amount - quote_need_take_pnl) / 10 ** pool.quote_decimals
+    if pool.base_mint in QUOTE_MINTS and pool.quote_mint not in QUOTE_MINTS:
+        return pool.quote_mint, quote_amount, pool.base_mint, base_amount
+    return pool.base_mint, base_amount, pool.quote_mint, quote_amount
+
+def fetch_onchain_market_data(pair_addresses):
+    """Preço e liquidez em USD das pools AMM v4, calculados a partir das reservas nas vaults.
+    Retorna {pair_address: (price_usd, liquidity_usd)}; pares que não são AMM v4 ficam de fora."""
+    wanted = list(dict.fromkeys([*pair_addresses, SOL_USD_REFERENCE_POOL]))
+    unknown = [pair_address for pair_address in wanted if amm_pool_cache.get(pair_address) is TTLCache.MISSING]
+    if unknown:
+        for pair_address, account in account_reader.get_accounts(unknown).items():
+            amm_pool_cache.set(pair_address, decode_amm_v4_pool(account), AMM_POOL_CACHE_TTL_SECONDS)
+    pools = {}
+    for pair_address in wanted:
+        pool = amm_pool_cache.get(pair_address)
+        if pool is not None and pool is not TTLCache.MISSING: pools[pair_address] = pool
+
+    # Estado das pools (PnL pendente) e saldos das vaults numa única leitura
+    accounts = account_reader.get_accounts(list(pools) + [vault for pool in pools.values() for vault in (pool.base_vault, pool.quote_vault)])
+    reserves = {}
+    for pair_address, pool in pools.items():
+        if any(accounts.get(key) is None for key in (pair_address, pool.base_vault, pool.quote_vault)): continue
+        pool_reserves = _amm_v4_reserves(pool, accounts, pair_address)
+        if pool_reserves: reserves[pair_address] = pool_reserves
+
+    if SOL_USD_REFERENCE_POOL not in reserves: raise ValueError("pool de referência SOL/USD indisponível")
+    _, sol_amount, _, usd_amount = reserves[SOL_USD_REFERENCE_POOL]
+    sol_usd = usd_amount / sol_amount
+    market_data = {}
+    for pair_address in pair_addresses:
+        if pair_address not in reserves: continue
+        _, token_amount, quote_mint, quote_amount = reserves[pair_address]
+        quote_usd = sol_usd if quote_mint == WSOL_MINT else 1.0 if quote_mint in USD_STABLE_MINTS else None
+        if quote_usd is None or token_amount <= 0 or quote_amount < 0: continue
+        market_data[pair_address] = (quote_amount / token_amount * quote_usd, 2 * quote_amount * quote_usd)
+    return market_data
+
+# --- 5. MOTOR DE COLETA ASSÍNCRONO ---
+class TokenBucket:
+    """Token bucket thread-safe: libera `rate` requisições por segundo, com rajadas de até `capacity`.
+    A taxa se adapta (AIMD): cai por RATE_LIMIT_DECREASE_FACTOR a cada 429/5xx e sobe aos poucos até o teto a cada sucesso;
+    um Retry-After pausa o bucket inteiro pelo tempo pedido."""
+    def __init__(self, rate, capacity=None):
+        self.ceiling = self.rate = rate; self.floor = rate * RATE_LIMIT_MIN_FRACTION; self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity; self.updated = time.monotonic(); self.lock = Lock()
+        self.paused_until = 0.0; self.last_decrease = 0.0; self.throttled = 0
+
+    def reserve(self):
+        """Reserva uma ficha e retorna quantos segundos o chamador deve esperar por ela."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+            self.tokens -= 1
+            return max(self.paused_until - now, 0.0) + (0.0 if self.tokens >= 0 else -self.tokens / self.rate)
+
+    def on_success(self):
+        with self.lock: self.rate = min(self.ceiling, self.rate + self.ceiling * RATE_LIMIT_INCREASE_FRACTION)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            now = time.monotonic(); self.throttled += 1
+            # Respostas de uma mesma rajada contam como um único sinal de congestionamento
+            if now - self.last_decrease >= 1 / self.rate:
+                self.rate = max(self.floor, self.rate * RATE_LIMIT_DECREASE_FACTOR); self.last_decrease = now
+                self.tokens = min(self.tokens, 0.0)
+            if retry_after: self.paused_until = max(self.paused_until, now + retry_after)
+
+    def stats(self):
+        with self.lock:
+            return {'rate': round(self.rate, 3), 'ceiling': self.ceiling, 'throttled': self.throttled, 'paused_for_s': round(max(self.paused_until - time.monotonic(), 0.0), 1)}
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay: time.sleep(delay)
+
+    async def acquire_async(self):
+        delay = self.reserve()
+        if delay: await asyncio.sleep(delay)
+
+_rate_limiters = {}; _rate_limiters_lock = Lock()
+def get_rate_limiter(host):
+    with _rate_limiters_lock:
+        if host not in _rate_limiters:
+            _rate_limiters[host] = TokenBucket(HOST_RATE_LIMITS.get(host, DEFAULT_HOST_RATE_LIMIT))
+        return _rate_limiters[host]
+
+def get_rate_limiter_stats():
+    with _rate_limiters_lock: limiters = dict(_rate_limiters)
+    return {host: limiter.stats() for host, limiter in limiters.items()}
+
+async def fetch_json_async(session, semaphore, url):
+    """GET assíncrono com o mesmo limitador adaptativo de http_request: 429/5xx voltam para a fila do host."""
+    host = urlsplit(url).hostname; limiter = get_rate_limiter(host)
+    async with semaphore:
+        for attempt in range(1, RATE_LIMIT_MAX_ATTEMPTS + 1):
+            await limiter.acquire_async()
+            started = time.perf_counter(); failed = True
+            try:
+                async with session.get(url, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                    if is_throttled_status(response.status) and attempt < RATE_LIMIT_MAX_ATTEMPTS:
+                        limiter.on_throttle(parse_retry_after(response.headers.get('Retry-After'))); continue
+                    response.raise_for_status()
+                    payload = await response.json(content_type=None)
+                    failed = False
+            finally:
+                record_http_latency(host, time.perf_counter() - started, failed)
+            limiter.on_success()
+            return payload
+
+async def fetch_pairs_batch_async(session, semaphore, pair_addresses):
+    """Busca vários pares em uma única requisição à DexScreener (endereços separados por vírgula)."""
+    payload = await fetch_json_async(session, semaphore, f"https://api.dexscreener.com/latest/dex/pairs/{TARGET_CHAIN}/{','.join(pair_addresses)}")
+    return {pair.get('pairAddress'): pair for pair in (payload.get('pairs') or [])}
+
+class AsyncHttpEngine:
+    """Event loop asyncio próprio, numa thread daemon, com uma única ClientSession que vive o processo todo:
+    as conexões keep-alive (TCP+TLS) sobrevivem entre os ticks de coleta em vez de serem refeitas a cada chamada."""
+    def __init__(self):
+        self.loop = None; self.session = None; self.lock = Lock()
+
+    def run(self, coroutine_factory):
+        """Executa `coroutine_factory(session)` no loop do motor e bloqueia até o resultado."""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                Thread(target=self.loop.run_forever, name='async-http', daemon=True).start()
+        return asyncio.run_coroutine_threadsafe(self._run(coroutine_factory), self.loop).result()
+
+    async def _run(self, coroutine_factory):
+        # Criada dentro do loop, que é o único a usá-la
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=min(COLLECT_CONCURRENCY, HTTP_POOL_SIZES['dexscreener']), keepalive_timeout=max(60, 4 * COLLECTION_TICK_SECONDS))
+            self.session = aiohttp.ClientSession(connector=connector)
+        return await coroutine_factory(self.session)
+
+    def close(self):
+        if self.loop is not None and self.session is not None:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+
+async_http = AsyncHttpEngine()
+
+async def _fetch_all_pairs_batches(session, batches):
+    # A vazão é limitada pelo token bucket do host
+    semaphore = asyncio.Semaphore(COLLECT_CONCURRENCY)
+    return await asyncio.gather(*(fetch_pairs_batch_async(session, semaphore, batch) for batch in batches), return_exceptions=True)
+
+def fetch_pairs_concurrently(batches):
+    """Busca todos os lotes em paralelo; retorna, para cada lote, o dict de pares ou a exceção ocorrida."""
+    return async_http.run(lambda session: _fetch_all_pairs_batches(session, batches))
+
+# --- 6. LÓGICA DO BOT ---
+
+class CycleScheduler:
+    """Mantém a cadência alvo: desconta a duração do ciclo da espera e alerta quando um ciclo estoura o intervalo."""
+    def __init__(self, interval, name='ciclo'):
+        self.interval = interval; self.name = name; self.next_start = time.monotonic(); self.cycle_started = None; self.overruns = 0
+
+    def start_cycle(self):
+        self.cycle_started = time.monotonic()
+
+    def finish_cycle(self):
+        """Retorna (duração do ciclo, segundos a dormir até o próximo início)."""
+        now = time.monotonic(); duration = now - self.cycle_started
+        self.next_start += self.interval
+        if now > self.next_start:
+            self.overruns += 1
+            print(f"⚠️ ALERTA: {self.name} levou {duration:.0f}s, acima da cadência de {self.interval}s ({self.overruns} estouro(s) até agora).")
+            # Começa o próximo ciclo já e realinha a grade a partir de agora, sem disparar ciclos atrasados em sequência
+            self.next_start = now
+        return duration, self.next_start - now
+
+    def reset(self):
+        self.next_start = time.monotonic()
+
+def join_shard_ring(cursor):
+    """Registra o heartbeat desta réplica e retorna as réplicas vivas, em ordem."""
+    cursor.execute("INSERT INTO collector_replicas (replica_id, heartbeat_at) VALUES (%s, now()) ON CONFLICT (replica_id) DO UPDATE SET heartbeat_at = now()", (REPLICA_ID,))
+    cursor.execute("SELECT replica_id FROM collector_replicas WHERE heartbeat_at > now() - make_interval(secs => %s) ORDER BY replica_id", (REPLICA_HEARTBEAT_TIMEOUT_SECONDS,))
+    return [row[0] for row in cursor.fetchall()]
+
+def leave_shard_ring():
+    """Remove esta réplica do registro para que as outras assumam sua fatia já no próximo refresh."""
+    if SHARDING_MODE != 'hash': return
+    try:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("DELETE FROM collector_replicas WHERE replica_id = %s", (REPLICA_ID,)); conn.commit()
+    except Exception as e:
+        print(f"Erro ao sair do anel de sharding: {e}")
+
+def shard_owner(token_id, replicas):
+    # Rendezvous hashing: quando uma réplica entra ou sai, só a fatia dela muda de dono
+    return max(replicas, key=lambda replica: hashlib.blake2b(f"{replica}:{token_id}".encode(), digest_size=8).digest())
+
+class SamplingScheduler:
+    """Heap de tokens monitorados ordenado pelo próximo horário de coleta, definido pela idade e pela volatilidade recente."""
+    def __init__(self):
+        self.heap = []; self.tokens = {}; self.last_refresh = None; self.replicas = [REPLICA_ID]
+        self.scheduled = set() # Ids com entrada no heap; cada token tem no máximo uma
+
+    def refresh(self, force=False):
+        """Recarrega os tokens em monitoramento; tokens novos entram na fila já devidos e os mortos saem."""
+        if not force and self.last_refresh is not None and time.monotonic() - self.last_refresh < SAMPLING_REFRESH_SECONDS: return
+        with db_connection() as conn, conn.cursor() as cursor:
+            owned_ids = None
+            if SHARDING_MODE == 'hash':
+                replicas = join_shard_ring(cursor); conn.commit()
+                cursor.execute("SELECT id FROM tokens WHERE status = 'monitoring' AND pair_address IS NOT NULL")
+                owned_ids = [token_id for (token_id,) in cursor.fetchall() if shard_owner(token_id, replicas) == REPLICA_ID]
+                if replicas != self.replicas: print(f"🔀 Réplicas ativas: {len(replicas)}. {REPLICA_ID} coleta {len(owned_ids)} token(s).")
+                self.replicas = replicas
+            cursor.execute('''
+                SELECT t.id, t.pair_address, t.symbol, t.discovered_at, v.volatility FROM tokens t
+                LEFT JOIN LATERAL (
+                    SELECT stddev_samp(r.change) AS volatility FROM (
+                        SELECT price_usd / NULLIF(lag(price_usd) OVER (ORDER BY timestamp), 0) - 1 AS change
+                        FROM (SELECT timestamp, price_usd FROM market_data WHERE token_id = t.id AND timestamp > now() - %s * interval '1 second' ORDER BY timestamp DESC LIMIT %s) recent
+                    ) r
+                ) v ON true
+                WHERE t.status = 'monitoring' AND t.pair_address IS NOT NULL AND (%s::integer[] IS NULL OR t.id = ANY(%s::integer[]))
+            ''', (SAMPLING_VOLATILITY_WINDOW_SECONDS, SAMPLING_VOLATILITY_LOOKBACK, owned_ids, owned_ids))
+            rows = cursor.fetchall()
+        now = time.time(); active = {}
+        for token_id, pair_address, symbol, discovered_at, volatility in rows:
+            active[token_id] = (pair_address, symbol, discovered_at, float(volatility) if volatility is not None else None)
+            # Um token que saiu da fatia e voltou ainda pode ter a entrada antiga no heap
+            if token_id not in self.scheduled: self._push(now, token_id)
+        self.tokens = active; self.last_refresh = time.monotonic()
+
+    def sampling_interval(self, token_id):
+        _, _, discovered_at, volatility = self.tokens[token_id]
+        age_hours = (datetime.now(timezone.utc) - discovered_at).total_seconds() / 3600 if discovered_at else float('inf')
+        interval = next((seconds for max_age, seconds in SAMPLING_TIERS if age_hours < max_age), SAMPLING_INTERVAL_OLD_TOKENS)
+        if volatility is not None and volatility >= SAMPLING_VOLATILE_THRESHOLD: interval = max(SAMPLING_TIERS[0][1], interval // 2)
+        elif volatility is not None and volatility < SAMPLING_QUIET_THRESHOLD: interval = min(SAMPLING_INTERVAL_OLD_TOKENS, interval * 2)
+        return interval
+
+    def pop_due(self):
+        """Retira da fila os tokens cujo horário já chegou, como (id, pair_address, symbol)."""
+        now = time.time(); due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, token_id = heapq.heappop(self.heap)
+            if token_id not in self.scheduled: continue
+            self.scheduled.discard(token_id)
+            if token_id in self.tokens: due.append((token_id, *self.tokens[token_id][:2]))
+        return due
+
+    def _push(self, when, token_id):
+        heapq.heappush(self.heap, (when, token_id)); self.scheduled.add(token_id)
+
+    def retry_soon(self, token_ids):
+        now = time.time()
+        for token_id in token_ids:
+            if token_id in self.tokens and token_id not in self.scheduled: self._push(now, token_id)
+
+    def reschedule(self, token_ids, dead_ids=()):
+        now = time.time()
+        for token_id in dead_ids: self.tokens.pop(token_id, None)
+        for token_id in token_ids:
+            if token_id in self.tokens and token_id not in self.scheduled: self._push(now + self.sampling_interval(token_id), token_id)
+
+sampling_scheduler = SamplingScheduler()
+
+class Worker(Thread):
+    """Thread que executa `step` em loop com cadência própria (interval=0 para workers guiados por fila) e registra heartbeat."""
+    def __init__(self, name, step, interval, stale_after):
+        super().__init__(name=name, daemon=True)
+        self.step = step; self.interval = interval; self.stale_after = stale_after
+        self.heartbeat = time.time(); self.iterations = 0; self.errors = 0; self.stopping = Event()
+
+    def run(self):
+        scheduler = CycleScheduler(self.interval, name=f"worker {self.name}") if self.interval else None
+        while not self.stopping.is_set():
+            self.heartbeat = time.time()
+            if scheduler: scheduler.start_cycle()
+            try:
+                self.step()
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ Erro no worker {self.name}: {e}"); traceback.print_exc()
+                print(f"Reiniciando o worker {self.name} em {WORKER_ERROR_BACKOFF_SECONDS} segundos...")
+                self.stopping.wait(WORKER_ERROR_BACKOFF_SECONDS)
+                if scheduler: scheduler.reset()
+                continue
+            self.iterations += 1; self.heartbeat = time.time()
+            if scheduler: self.stopping.wait(scheduler.finish_cycle()[1])
+
+    def status(self):
+        since_heartbeat = time.time() - self.heartbeat
+        return {'alive': self.is_alive() and since_heartbeat < self.stale_after, 'seconds_since_heartbeat': round(since_heartbeat, 1), 'iterations': self.iterations, 'errors': self.errors}
+
+profiling_queue = queue.Queue(maxsize=PROFILING_QUEUE_SIZE) # Tokens já gravados (token_id, token_address, symbol) aguardando perfil
+new_tokens_queue = queue.Queue() # Ids de tokens recém-gravados, para a coleta incluí-los sem esperar o próximo refresh
+WORKER_QUEUES = {'profiling': profiling_queue, 'new_tokens': new_tokens_queue}
+WORKERS = {}
+
+class AdvisoryLockLeader:
+    """Eleição de líder por advisory lock de sessão, numa conexão dedicada (fora do pool) mantida enquanto a réplica lidera.
+    Se o líder cai, o Postgres encerra a sessão e libera o lock; outra réplica o obtém na sua próxima tentativa."""
+    def __init__(self, lock_key, role):
+        self.lock_key = lock_key; self.role = role; self.conn = None; self.lock = RLock()
+
+    def is_leader(self):
+        # Consultado pelos workers de descoberta por polling e por streaming; um só tenta se eleger por vez
+        with self.lock: return self._check_leadership()
+
+    def _check_leadership(self):
+        if self.conn is not None:
+            try:
+                with self.conn.cursor() as cursor: cursor.execute("SELECT 1")
+                return True
+            except psycopg2.Error:
+                print(f"⚠️ Conexão de liderança ({self.role}) perdida; tentando se eleger novamente.")
+                self.release()
+        try:
+            conn = psycopg2.connect(DATABASE_URL, keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3)
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_key,))
+                acquired = cursor.fetchone()[0]
+        except psycopg2.Error as e:
+            print(f"Erro na eleição de líder ({self.role}): {e}")
+            return False
+        if not acquired:
+            conn.close(); return False
+        print(f"👑 {REPLICA_ID} é agora líder da {self.role}.")
+        self.conn = conn
+        return True
+
+    def release(self):
+        with self.lock:
+            if self.conn is None: return
+            try: self.conn.close()
+            except psycopg2.Error: pass
+            self.conn = None
+
+discovery_leader = AdvisoryLockLeader(DISCOVERY_LEADER_LOCK_KEY, 'descoberta')
+
+def discovery_step():
+    # Só a líder consulta as fontes de descoberta; as demais réplicas apenas coletam
+    if not discovery_leader.is_leader(): return
+    requeue_unprofiled_tokens()
+    # Só os tokens efetivamente inseridos por esta réplica seguem para o perfil; a coleta já pode incluí-los
+    for claimed in claim_new_tokens(discover_new_pairs()):
+        new_tokens_queue.put(claimed[0])
+        profiling_queue.put(claimed)
+    print_discovery_report()
+    print_http_latency_report()
+
+def profiling_step():
+    try: batch = [profiling_queue.get(timeout=1)]
+    except queue.Empty: return
+    while len(batch) < PROFILING_BATCH_SIZE:
+        try: batch.append(profiling_queue.get_nowait())
+        except queue.Empty: break
+    profile_and_store_tokens(batch)
+
+def collection_step():
+    new_tokens = 0
+    while True:
+        try: new_tokens_queue.get_nowait(); new_tokens += 1
+        except queue.Empty: break
+    sampling_scheduler.refresh(force=new_tokens > 0)
+    due = sampling_scheduler.pop_due()
+    try:
+        dead_ids, unsampled_ids = collect_and_analyze_data(due)
+    except Exception:
+        # Os tokens já saíram do heap; sem isso um erro inesperado os deixaria sem amostragem para sempre
+        sampling_scheduler.reschedule([token_id for token_id, _, _ in due])
+        raise
+    sampling_scheduler.reschedule([token_id for token_id, _, _ in due if token_id not in unsampled_ids], dead_ids)
+    # Lotes que falharam mesmo após as novas tentativas voltam já devidos, em vez de perder a amostra até o próximo intervalo
+    sampling_scheduler.retry_soon(unsampled_ids)
+    maintain_partitions_if_due()
+
+def start_workers():
+    workers = [
+        Worker('discovery', discovery_step, CYCLE_INTERVAL_SECONDS, stale_after=2 * CYCLE_INTERVAL_SECONDS + 300),
+        Worker('profiling', profiling_step, 0, stale_after=900),
+        Worker('collection', collection_step, COLLECTION_TICK_SECONDS, stale_after=max(20 * COLLECTION_TICK_SECONDS, 600)),
+    ]
+    if STREAM_DISCOVERY_SOURCES and RPC_WS_URL:
+        workers.append(Worker('stream', stream_discovery_step, 0, stale_after=STREAM_SESSION_SECONDS + WORKER_ERROR_BACKOFF_SECONDS + 300))
+    for worker in workers:
+        WORKERS[worker.name] = worker; worker.start()
+    return workers
 
 # --- FUNÇÃO QUE ESTAVA FALTANDO ---
 def main_bot_logic():
-    """Função que contém o loop principal de coleta de dados."""
+    """Configura o banco e sobe os workers de descoberta, perfilamento e coleta, cada um com sua cadência."""
+    DISCOVERY_SOURCES[:] = known_discovery_sources(DISCOVERY_SOURCES)
     setup_database()
-    while True:
-        try:
-            discover_and_profile_new_pairs()
-            collect_and_analyze_data()
-            print(f"\n--- Ciclo completo. Próxima verificação em 15 minutos --- ({datetime.now().strftime('%H:%M:%S')})")
-            time.sleep(900)
-        except KeyboardInterrupt:
-            print("\n🛑 Bot interrompido.")
-            break
-        except Exception as e:
-            print(f"❌ Erro fatal no loop principal: {e}")
-            traceback.print_exc()
-            print("Reiniciando em 60 segundos...")
-            time.sleep(60)
+    workers = start_workers()
+    # `docker stop` manda SIGTERM: segue o mesmo encerramento do Ctrl+C, liberando a liderança e a fatia do sharding na hora
+    terminated = Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: terminated.set())
+    try:
+        while all(worker.is_alive() for worker in workers) and not terminated.wait(5): pass
+        if terminated.is_set(): print("\n🛑 SIGTERM recebido; encerrando.")
+        else: print("❌ Um worker terminou inesperadamente; encerrando para o container ser reiniciado.")
+    except KeyboardInterrupt:
+        print("\n🛑 Bot interrompido.")
+    for worker in workers: worker.stopping.set()
+    discovery_leader.release()
+    leave_shard_ring()
+    async_http.close()
+
+def parse_security_data(security_data):
+    if not security_data: return None, None, None
+    return bool(int(security_data.get('is_honeypot') or 0)), float(security_data.get('buy_tax') or 0), float(security_data.get('sell_tax') or 0)
+
+def profile_new_tokens(token_addresses):
+    """Busca segurança (GoPlus, em lotes) e holders (RPC) de todos os tokens em paralelo; os token buckets de cada host limitam a vazão.
+    Tokens com alguma consulta que falhou ficam com perfil None."""
+    with ThreadPoolExecutor(max_workers=PROFILE_CONCURRENCY) as executor:
+        chunks = [token_addresses[start:start + GOPLUS_BATCH_SIZE] for start in range(0, len(token_addresses), GOPLUS_BATCH_SIZE)]
+        security_futures = [executor.submit(get_security_data_batch, chunk) for chunk in chunks]
+        holder_futures = {address: executor.submit(get_holder_count, address) for address in token_addresses}
+        security = {}
+        for future in security_futures: security.update(future.result())
+        profiles = {}
+        for address in token_addresses:
+            holder_count = holder_futures[address].result()
+            failed = security.get(address) is LOOKUP_FAILED or holder_count is LOOKUP_FAILED
+            profiles[address] = None if failed else (*parse_security_data(security.get(address)), holder_count)
+        return profiles
+
+# Candidato normalizado, igual para todas as fontes; seen_at é quando a fonte o entregou e pair_created_at quando o par nasceu
+DiscoveryCandidate = namedtuple('DiscoveryCandidate', 'token_address pair_address symbol source pair_created_at seen_at')
+_discovery_stats = {}; _discovery_stats_lock = Lock()
+# mint -> {fonte: primeiro avistamento}, entre ciclos; decide qual fonte viu cada mint primeiro (LRU de KNOWN_TOKENS_CACHE_SIZE mints)
+_discovery_sightings = OrderedDict()
+
+def _parse_iso_timestamp(value):
+    try: return datetime.fromisoformat(value.replace('Z', '+00:00')) if value else None
+    except ValueError: return None
+
+_pending_discovery_cursors = {}; _pending_discovery_cursors_lock = Lock()
+
+def load_discovery_cursor(source):
+    """Retorna a marca d'água (last_seen_at, last_seen_pair) gravada para a fonte, ou (None, None)."""
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT last_seen_at, last_seen_pair FROM discovery_cursors WHERE source = %s", (source,))
+        return cursor.fetchone() or (None, None)
+
+def set_pending_discovery_cursor(source, last_seen_at, last_seen_pair):
+    # Só vai para o banco junto com os tokens, em claim_new_tokens; se a gravação falhar, o próximo ciclo recomeça da marca anterior
+    with _pending_discovery_cursors_lock: _pending_discovery_cursors[source] = (last_seen_at, last_seen_pair)
+
+def take_pending_discovery_cursors():
+    with _pending_discovery_cursors_lock:
+        pending = [(source, *cursor) for source, cursor in _pending_discovery_cursors.items()]
+        _pending_discovery_cursors.clear()
+    return pending
+
+def _parse_geckoterminal_pool(pool, seen_at):
+    attributes = pool.get('attributes', {}); relationships = pool.get('relationships', {})
+    pair_address = attributes.get('address'); base_token_data = relationships.get('base_token', {}).get('data', {})
+    token_id_string = base_token_data.get('id')
+    if not all([pair_address, token_id_string]): return None
+    symbol = attributes.get('name', 'N/A').split(' / ')[0]
+    return DiscoveryCandidate(token_id_string.split('_')[-1], pair_address, symbol, 'geckoterminal', _parse_iso_timestamp(attributes.get('pool_created_at')), seen_at)
+
+def _fetch_geckoterminal_page(page):
+    response = http_request('geckoterminal', 'GET', f"https://api.geckoterminal.com/api/v2/networks/{TARGET_CHAIN}/new_pools", params={'page': page}, timeout=15)
+    response.raise_for_status()
+    seen_at = datetime.now(timezone.utc)
+    return [candidate for candidate in (_parse_geckoterminal_pool(pool, seen_at) for pool in response.json().get('data', [])) if candidate]
+
+def fetch_geckoterminal_candidates():
+    """Percorre as páginas do new_pools (mais novos primeiro) até chegar ao último par já visto, a pools mais velhos que
+    MAX_PAIR_AGE_HOURS ou a GECKOTERMINAL_MAX_PAGES. A página seguinte é buscada enquanto a atual é processada."""
+    last_seen_at, last_seen_pair = load_discovery_cursor('geckoterminal')
+    age_cutoff = datetime.now(timezone.utc) - timedelta(hours=MAX_PAIR_AGE_HOURS)
+    def already_seen(candidate):
+        if candidate.pair_address == last_seen_pair: return True
+        if candidate.pair_created_at is None: return False
+        return candidate.pair_created_at < age_cutoff or (last_seen_at is not None and candidate.pair_created_at < last_seen_at)
+
+    candidates = []; pages = 0
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        next_page = prefetcher.submit(_fetch_geckoterminal_page, 1)
+        for page in range(1, GECKOTERMINAL_MAX_PAGES + 1):
+            page_candidates = next_page.result(); pages += 1
+            # Só pede a próxima página se até o par mais antigo desta ainda for novo
+            has_more = bool(page_candidates) and page < GECKOTERMINAL_MAX_PAGES and not already_seen(page_candidates[-1])
+            if has_more: next_page = prefetcher.submit(_fetch_geckoterminal_page, page + 1)
+            for candidate in page_candidates:
+                if already_seen(candidate): has_more = False; break
+                candidates.append(candidate)
+            if not has_more: break
+    # Pode ter sido pedida uma página a mais que não foi usada; o executor espera por ela ao sair
+
+    if candidates:
+        newest = max(candidates, key=lambda candidate: candidate.pair_created_at or candidate.seen_at)
+        set_pending_discovery_cursor('geckoterminal', newest.pair_created_at or newest.seen_at, newest.pair_address)
+    print(f"  - Geckoterminal: {pages} página(s), {len(candidates)} pool(s) novo(s).")
+    return candidates
+
+def fetch_dexscreener_candidates():
+    """Pares retornados pela busca `search?q=new` da DexScreener, filtrados para a rede alvo."""
+    response = http_request('dexscreener', 'GET', "https://api.dexscreener.com/latest/dex/search?q=new", timeout=15)
+    response.raise_for_status()
+    seen_at = datetime.now(timezone.utc); candidates = []
+    for pair in response.json().get('pairs') or []:
+        if pair.get('chainId') != TARGET_CHAIN: continue
+        token_address = pair.get('baseToken', {}).get('address'); pair_address = pair.get('pairAddress')
+        if not all([token_address, pair_address]): continue
+        created_ms = pair.get('pairCreatedAt')
+        pair_created_at = datetime.fromtimestamp(created_ms / 1000, timezone.utc) if created_ms else None
+        candidates.append(DiscoveryCandidate(token_address, pair_address, pair.get('baseToken', {}).get('symbol', 'N/A'), 'dexscreener', pair_created_at, seen_at))
+    return candidates
+
+# Fontes disponíveis: nome -> função sem argumentos que retorna uma lista de DiscoveryCandidate
+DISCOVERY_SOURCE_FETCHERS = {
+    'geckoterminal': fetch_geckoterminal_candidates,
+    'dexscreener': fetch_dexscreener_candidates,
+}
+
+def known_discovery_sources(sources):
+    """Filtra as fontes pelo registro DISCOVERY_SOURCE_FETCHERS, avisando das desconhecidas (nome digitado errado)."""
+    unknown = [source for source in sources if source not in DISCOVERY_SOURCE_FETCHERS]
+    if unknown: print(f"⚠️ Fontes de descoberta desconhecidas ignoradas: {', '.join(unknown)} (disponíveis: {', '.join(DISCOVERY_SOURCE_FETCHERS)})")
+    return [source for source in sources if source in DISCOVERY_SOURCE_FETCHERS]
+
+def _discovery_source_stats(source):
+    return _discovery_stats.setdefault(source, {'polls': 0, 'errors': 0, 'candidates': 0, 'first_seen': 0, 'latency_samples': 0, 'total_latency_s': 0.0, 'max_latency_s': 0.0})
+
+def record_discovery_poll(source, candidates=(), failed=False, polled_at=None):
+    """Acumula, por fonte, consultas, mints avistados e a latência (avistamento - pair_created_at) com que os entregou.
+    Cada mint conta uma vez por fonte, já conhecido ou não. O avistamento é o início da consulta (`polled_at`) ou o seen_at
+    do evento; o mais cedo entre as fontes leva o first_seen, e fontes consultadas no mesmo ciclo empatam."""
+    with _discovery_stats_lock:
+        stats = _discovery_source_stats(source)
+        stats['polls'] += 1
+        if failed: stats['errors'] += 1
+        for candidate in candidates:
+            sightings = _discovery_sightings.setdefault(candidate.token_address, {})
+            _discovery_sightings.move_to_end(candidate.token_address)
+            if source in sightings: continue
+            sighted_at = polled_at or candidate.seen_at
+            earliest = min(sightings.values(), default=None)
+            if earliest is None or sighted_at <= earliest: stats['first_seen'] += 1
+            if earliest is not None and sighted_at < earliest:
+                # Uma consulta iniciada antes terminou depois: quem tinha o primeiro lugar o perde
+                for other, other_at in sightings.items():
+                    if other_at == earliest: _discovery_source_stats(other)['first_seen'] -= 1
+            sightings[source] = sighted_at; stats['candidates'] += 1
+            if candidate.pair_created_at is None: continue
+            latency = max((sighted_at - candidate.pair_created_at).total_seconds(), 0.0)
+            stats['latency_samples'] += 1; stats['total_latency_s'] += latency; stats['max_latency_s'] = max(stats['max_latency_s'], latency)
+        while len(_discovery_sightings) > KNOWN_TOKENS_CACHE_SIZE: _discovery_sightings.popitem(last=False)
+
+def get_discovery_stats():
+    with _discovery_stats_lock:
+        return {source: {**stats, 'avg_latency_s': round(stats['total_latency_s'] / stats['latency_samples'], 1) if stats['latency_samples'] else None}
+                for source, stats in _discovery_stats.items()}
+
+def print_discovery_report():
+    for source, stats in get_discovery_stats().items():
+        latency = f"{stats['avg_latency_s']:.0f} s" if stats['avg_latency_s'] is not None else "n/d"
+        print(f"  - Fonte {source}: {stats['candidates']} candidato(s), {stats['first_seen']} visto(s) primeiro, latência média {latency}, {stats['errors']} erro(s)")
+
+def discover_new_pairs(sources=None):
+    """Consulta as fontes de descoberta em paralelo e retorna um DiscoveryCandidate por mint (fora do cache de conhecidos),
+    ficando com o da fonte que o entregou primeiro. Uma fonte com erro não impede as demais."""
+    sources = known_discovery_sources(sources or DISCOVERY_SOURCES)
+    if not sources:
+        print("⚠️ Nenhuma fonte de descoberta válida configurada (DISCOVERY_SOURCES); descoberta por polling desativada.")
+        return []
+    print(f"\n🔎 Procurando novos pares na rede {TARGET_CHAIN} via {', '.join(sources)}...")
+    merged = {}; polled_at = datetime.now(timezone.utc)
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {source: executor.submit(DISCOVERY_SOURCE_FETCHERS[source]) for source in sources}
+        for source, future in futures.items():
+            try: candidates = future.result()
+            except Exception as e:
+                print(f"  - Erro na fonte de descoberta {source}: {e}")
+                record_discovery_poll(source, failed=True); continue
+            recent = [candidate for candidate in candidates if not candidate.pair_created_at or candidate.seen_at - candidate.pair_created_at <= timedelta(hours=MAX_PAIR_AGE_HOURS)]
+            # Mints já conhecidos também contam na estatística: a fonte mais lenta os entrega depois
+            record_discovery_poll(source, recent, polled_at=polled_at)
+            for candidate in recent:
+                if candidate.token_address in known_tokens: continue
+                current = merged.get(candidate.token_address)
+                if current is None or candidate.seen_at < current.seen_at: merged[candidate.token_address] = candidate
+    return list(merged.values())
+
+def claim_new_tokens(candidates, advance_cursors=True):
+    """Insere os candidatos num único INSERT ... ON CONFLICT DO NOTHING e retorna só os que esta chamada criou,
+    como (token_id, token_address, symbol). Endereços já gravados (por outra réplica ou fonte) são ignorados sem erro."""
+    cursors = take_pending_discovery_cursors() if advance_cursors else []
+    if not candidates and not cursors: return []
+    rows = [(candidate.token_address, candidate.pair_address, TARGET_CHAIN, candidate.symbol, candidate.seen_at, candidate.source, candidate.pair_created_at) for candidate in candidates]
+    with db_connection() as conn, conn.cursor() as cursor:
+        inserted = psycopg2.extras.execute_values(cursor, "INSERT INTO tokens (token_address, pair_address, chain, symbol, discovered_at, discovery_source, pair_created_at) VALUES %s ON CONFLICT (token_address) DO NOTHING RETURNING id, token_address", rows, fetch=True) if rows else []
+        # A marca d'água das fontes paginadas avança na mesma transação dos tokens que ela cobre
+        if cursors: psycopg2.extras.execute_values(cursor, "INSERT INTO discovery_cursors (source, last_seen_at, last_seen_pair) VALUES %s ON CONFLICT (source) DO UPDATE SET last_seen_at = EXCLUDED.last_seen_at, last_seen_pair = EXCLUDED.last_seen_pair, updated_at = now()", cursors)
+        conn.commit()
+    known_tokens.add([candidate.token_address for candidate in candidates])
+    by_address = {candidate.token_address: candidate for candidate in candidates}
+    claimed = []
+    for token_id, token_address in inserted:
+        candidate = by_address[token_address]
+        print(f"✨ Descoberto via {candidate.source}: {candidate.symbol} ({candidate.pair_address[:6]}...)")
+        claimed.append((token_id, token_address, candidate.symbol))
+    return claimed
+
+# --- Descoberta em tempo real (logsSubscribe) ---
+RAYDIUM_INITIALIZE2_TAG = 1
+PUMPFUN_CREATE_DISCRIMINATOR = hashlib.sha256(b'global:create').digest()[:8] # Discriminador Anchor da instrução `create`
+
+def _read_borsh_string(data, offset):
+    (length,) = struct.unpack_from('<I', data, offset)
+    return data[offset + 4:offset + 4 + length].decode('utf-8', 'replace'), offset + 4 + length
+
+def decode_raydium_initialize2(instruction):
+    """(mint, pool, símbolo) de um `initialize2` da AMM v4; contas 4 = amm, 8 = coin mint, 9 = pc mint."""
+    data = b58decode(instruction.get('data', '')); accounts = instruction.get('accounts', [])
+    if not data or data[0] != RAYDIUM_INITIALIZE2_TAG or len(accounts) < 10: return None
+    coin_mint, pc_mint = accounts[8], accounts[9]
+    return (pc_mint if coin_mint in QUOTE_MINTS else coin_mint), accounts[4], 'N/A'
+
+def decode_pumpfun_create(instruction):
+    """(mint, bonding curve, símbolo) de um `create` da Pump.fun; dados = discriminador + name, symbol, uri (strings borsh)."""
+    data = b58decode(instruction.get('data', '')); accounts = instruction.get('accounts', [])
+    if data[:8] != PUMPFUN_CREATE_DISCRIMINATOR or len(accounts) < 3: return None
+    _, offset = _read_borsh_string(data, 8)
+    symbol, _ = _read_borsh_string(data, offset)
+    return accounts[0], accounts[2], symbol or 'N/A'
+
+# Fontes por streaming: nome -> (programa assinado, linha de log que marca a criação do pool, decodificador da instrução)
+STREAM_SOURCES = {
+    'raydium': (RAYDIUM_AMM_V4_PROGRAM_ID, 'Program log: initialize2', decode_raydium_initialize2),
+    'pumpfun': (PUMPFUN_PROGRAM_ID, 'Program log: Instruction: Create', decode_pumpfun_create),
+}
+
+def _transaction_instructions(transaction):
+    instructions = list(transaction['transaction']['message']['instructions'])
+    for inner in (transaction.get('meta') or {}).get('innerInstructions') or []: instructions.extend(inner.get('instructions', []))
+    return instructions
+
+def fetch_stream_candidate(source, signature, seen_at):
+    """Busca a transação do evento e decodifica o novo pool; None se ela não contém a instrução esperada."""
+    program_id, _, decoder = STREAM_SOURCES[source]
+    for attempt in range(3):
+        # Logo após a notificação o nó pode ainda não servir a transação
+        transaction = _rpc_call('getTransaction', [signature, {'encoding': 'jsonParsed', 'maxSupportedTransactionVersion': 0, 'commitment': 'confirmed'}], timeout=15)
+        if transaction: break
+        time.sleep(1)
+    else:
+        return None
+    for instruction in _transaction_instructions(transaction):
+        if instruction.get('programId') != program_id: continue
+        decoded = decoder(instruction)
+        if decoded:
+            block_time = transaction.get('blockTime')
+            return DiscoveryCandidate(*decoded, source, datetime.fromtimestamp(block_time, timezone.utc) if block_time else None, seen_at)
+    return None
+
+def process_stream_event(source, signature, seen_at):
+    """Decodifica o evento e, se o mint for novo, grava-o e o entrega direto às filas de perfilamento e coleta."""
+    try:
+        candidate = fetch_stream_candidate(source, signature, seen_at)
+        if candidate is None: return
+        record_discovery_poll(source, [candidate])
+        if candidate.token_address in known_tokens: return
+        for claimed in claim_new_tokens([candidate], advance_cursors=False):
+            new_tokens_queue.put(claimed[0])
+            profiling_queue.put(claimed)
+    except Exception as e:
+        print(f"  - Erro ao processar evento {source} {signature[:8]}...: {e}")
+
+def _is_pool_creation(logs, marker):
+    return any(line == marker or line.startswith(marker + ':') for line in logs or [])
+
+async def _stream_new_pools(sources, duration, executor):
+    loop = asyncio.get_running_loop(); deadline = loop.time() + duration
+    async with aiohttp.ClientSession() as session, session.ws_connect(RPC_WS_URL, heartbeat=30) as ws:
+        requests_by_id = dict(enumerate(sources, 1)); subscriptions = {}
+        for request_id, source in requests_by_id.items():
+            await ws.send_json({"jsonrpc": "2.0", "id": request_id, "method": "logsSubscribe", "params": [{"mentions": [STREAM_SOURCES[source][0]]}, {"commitment": "confirmed"}]})
+        print(f"📡 Assinando logs de {', '.join(sources)} via {urlsplit(RPC_WS_URL).hostname}...")
+        while (remaining := deadline - loop.time()) > 0:
+            timeout = min(remaining, STREAM_IDLE_TIMEOUT_SECONDS)
+            try: message = await ws.receive(timeout=timeout)
+            except asyncio.TimeoutError:
+                if timeout < STREAM_IDLE_TIMEOUT_SECONDS: break
+                raise ConnectionError(f"nenhuma mensagem do websocket em {STREAM_IDLE_TIMEOUT_SECONDS}s")
+            if message.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                raise ConnectionError(f"websocket encerrado ({message.type.name})")
+            if message.type != aiohttp.WSMsgType.TEXT: continue
+            payload = message.json()
+            if 'id' in payload:
+                if 'error' in payload: raise ValueError(f"logsSubscribe: {payload['error']}")
+                subscriptions[payload['result']] = requests_by_id[payload['id']]; continue
+            params = payload.get('params') or {}
+            source = subscriptions.get(params.get('subscription'))
+            value = (params.get('result') or {}).get('value') or {}
+            if source is None or value.get('err') is not None or not _is_pool_creation(value.get('logs'), STREAM_SOURCES[source][1]): continue
+            # getTransaction e gravação são bloqueantes: rodam fora do loop para não atrasar a leitura do websocket
+            loop.run_in_executor(executor, process_stream_event, source, value['signature'], datetime.now(timezone.utc))
+
+def stream_discovery_step():
+    """Mantém uma sessão de logsSubscribe por até STREAM_SESSION_SECONDS; o worker reconecta em seguida (ou após erro)."""
+    if not discovery_leader.is_leader():
+        time.sleep(30); return
+    with ThreadPoolExecutor(max_workers=PROFILE_CONCURRENCY) as executor:
+        asyncio.run(_stream_new_pools(STREAM_DISCOVERY_SOURCES, STREAM_SESSION_SECONDS, executor))
+
+def profile_and_store_tokens(claimed):
+    """Perfila em paralelo os tokens já inseridos por `claim_new_tokens` e grava os perfis num único UPDATE.
+    Tokens cuja consulta falhou ficam com profiled_at NULL e voltam pela recuperação de `requeue_unprofiled_tokens`."""
+    profiles = profile_new_tokens([token_address for _, token_address, _ in claimed])
+    rows = []
+    for token_id, token_address, symbol in claimed:
+        if profiles[token_address] is None:
+            print(f"  - {symbol}: consulta de perfil falhou; será perfilado de novo mais tarde."); continue
+        is_honeypot, buy_tax, sell_tax, holder_count = profiles[token_address]
+        if is_honeypot is None: print(f"  - Aviso: Dados de segurança para {symbol} não encontrados.")
+        print(f"  - {symbol}: Contagem de Holders: {holder_count}")
+        rows.append((token_id, holder_count, is_honeypot, buy_tax, sell_tax))
+
+    if not rows: return 0
+    with db_connection() as conn, conn.cursor() as cursor:
+        psycopg2.extras.execute_values(cursor, "UPDATE tokens SET initial_holder_count = v.holder_count, is_honeypot = v.is_honeypot, buy_tax = v.buy_tax, sell_tax = v.sell_tax, profiled_at = now() FROM (VALUES %s) AS v (id, holder_count, is_honeypot, buy_tax, sell_tax) WHERE tokens.id = v.id",
+                                       rows, template="(%s, %s::integer, %s::boolean, %s::real, %s::real)")
+        conn.commit()
+    return len(rows)
+
+def requeue_unprofiled_tokens():
+    """Devolve à fila de perfilamento os tokens gravados há mais de PROFILING_RECOVERY_GRACE_SECONDS e ainda sem perfil
+    (fila perdida num restart, cheia ou com erro no perfilamento). Retorna quantos foram reenfileirados."""
+    with profiling_queue.mutex: queued = {item[0] for item in profiling_queue.queue}
+    with db_connection() as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT id, token_address, symbol FROM tokens WHERE profiled_at IS NULL AND status = 'monitoring' AND discovered_at < now() - %s * interval '1 second' ORDER BY discovered_at LIMIT %s",
+                       (PROFILING_RECOVERY_GRACE_SECONDS, PROFILING_QUEUE_SIZE))
+        rows = [row for row in cursor.fetchall() if row[0] not in queued]
+    requeued = 0
+    for row in rows:
+        try: profiling_queue.put_nowait(row)
+        except queue.Full: break
+        requeued += 1
+    if requeued: print(f"🔁 {requeued} token(s) sem perfil voltaram para a fila de perfilamento.")
+    return requeued
 
 def discover_and_profile_new_pairs():
-    print(f"\n🔎 Procurando novos pares na rede {TARGET_CHAIN} via Geckoterminal...")
+    """Descoberta e perfilamento em sequência, numa única chamada (fora dos workers)."""
     try:
-        response = requests.get(f"https://api.geckoterminal.com/api/v2/networks/{TARGET_CHAIN}/new_pools", timeout=15)
-        response.raise_for_status()
-        pools_data = response.json().get('data', [])
-        if not pools_data:
-            print("  - Nenhum pool novo retornado pela Geckoterminal.")
-            return
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        for pool in pools_data:
-            attributes = pool.get('attributes', {}); relationships = pool.get('relationships', {})
-            pair_address = attributes.get('address'); base_token_data = relationships.get('base_token', {}).get('data', {})
-            token_id_string = base_token_data.get('id')
-            if not all([pair_address, token_id_string]): continue
-
-            token_address = token_id_string.split('_')[-1]
-            symbol = attributes.get('name', 'N/A').split(' / ')[0]
-            
-            cursor.execute("SELECT id FROM tokens WHERE token_address = %s", (token_address,))
-            if cursor.fetchone() is None:
-                print(f"✨ Descoberto via Geckoterminal: {symbol} ({pair_address[:6]}...)")
-                
-                security_data = get_security_data(token_address)
-                time.sleep(1)
-                
-                if security_data:
-                    is_honeypot = bool(int(security_data.get('is_honeypot', 0))); buy_tax = float(security_data.get('buy_tax', 0)); sell_tax = float(security_data.get('sell_tax', 0))
-                else:
-                    print(f"  - Aviso: Dados de segurança para {symbol} não encontrados.")
-                    is_honeypot = None; buy_tax = None; sell_tax = None
-
-                holder_count = get_holder_count(token_address)
-                print(f"  - Contagem de Holders: {holder_count}")
-                time.sleep(1)
-                
-                cursor.execute(
-                    "INSERT INTO tokens (token_address, pair_address, chain, symbol, discovered_at, initial_holder_count, is_honeypot, buy_tax, sell_tax) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                    (token_address, pair_address, TARGET_CHAIN, symbol, datetime.utcnow(), holder_count, is_honeypot, buy_tax, sell_tax)
-                )
-                conn.commit()
+        claimed = claim_new_tokens(discover_new_pairs())
+        if claimed: profile_and_store_tokens(claimed)
+        return [token_id for token_id, _, _ in claimed]
     except Exception as e:
         print(f"Erro na fase de descoberta: {e}")
         traceback.print_exc()
-    finally:
-        if 'conn' in locals() and not conn.closed:
-            cursor.close()
-            conn.close()
-
-def collect_and_analyze_data():
-    conn = get_db_connection(); cursor = conn.cursor()
-    cursor.execute("SELECT id, pair_address, symbol FROM tokens WHERE status = 'monitoring'")
-    tokens_to_monitor = cursor.fetchall()
-    if not tokens_to_monitor:
-        print("📊 Nenhum token ativo para monitorar.")
-        return
-    print(f"\n📊 Coletando dados para {len(tokens_to_monitor)} token(s) ativo(s)...")
-    for token_id, pair_address, symbol in tokens_to_monitor:
+    return []
+
+def parse_market_data(data):
+    price_usd = float(data.get('priceUsd') or 0); liquidity_usd = float((data.get('liquidity') or {}).get('usd') or 0); volume_h1 = float((data.get('volume') or {}).get('h1') or 0)
+    txns_h1 = (data.get('txns') or {}).get('h1') or {}; buys_h1 = int(txns_h1.get('buys') or 0); sells_h1 = int(txns_h1.get('sells') or 0)
+    return price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1
+
+def get_death_reason(liquidity_usd, volume_h1):
+    if liquidity_usd > 1 and liquidity_usd < DEATH_LIQUIDITY_THRESHOLD_USD: return "liquidity_collapse"
+    # Leituras on-chain não trazem volume; nelas só a liquidez decide
+    if volume_h1 is not None and volume_h1 < DEATH_VOLUME_THRESHOLD_USD and liquidity_usd > 1: return "low_volume"
+    return None
+
+def record_market_snapshot(token_id, symbol, timestamp, market_data, dead_ids):
+    price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1 = market_data
+    market_data_writer.add_snapshot(token_id, timestamp, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1)
+    print(f"  -> {symbol}: Preço ${price_usd:.8f}, Liq ${liquidity_usd:,.0f}")
+    death_reason = get_death_reason(liquidity_usd, volume_h1)
+    if death_reason:
+        market_data_writer.mark_dead(token_id, timestamp, death_reason); dead_ids.add(token_id)
+        print(f"  💀 {symbol} foi marcado como 'morto'. Motivo: {death_reason}")
+
+def collect_and_analyze_data(tokens_to_monitor=None):
+    """Coleta os tokens informados (id, pair_address, symbol), ou todos em monitoramento.
+    Retorna (ids marcados como mortos, ids de lotes que falharam e não foram amostrados)."""
+    if tokens_to_monitor is None:
+        with db_connection() as conn, conn.cursor() as cursor:
+            cursor.execute("SELECT id, pair_address, symbol FROM tokens WHERE status = 'monitoring'")
+            tokens_to_monitor = [row for row in cursor.fetchall() if row[1]]
+        if not tokens_to_monitor: print("📊 Nenhum token ativo para monitorar.")
+    if not tokens_to_monitor: return set(), set()
+    dead_ids = set(); unsampled_ids = set()
+    if MARKET_DATA_SOURCE == 'onchain':
+        print(f"\n📊 Lendo reservas on-chain de {len(tokens_to_monitor)} token(s) ativo(s)...")
         try:
-            url = f"https://api.dexscreener.com/latest/dex/pairs/{TARGET_CHAIN}/{pair_address}"
-            response = requests.get(url, timeout=10)
-            data = response.json().get('pair')
-            if not data: continue
-            price_usd = float(data.get('priceUsd', 0)); liquidity_usd = float(data.get('liquidity', {}).get('usd', 0)); volume_h1 = float(data.get('volume', {}).get('h1', 0)); buys_h1 = int(data.get('txns', {}).get('h1', {}).get('buys', 0)); sells_h1 = int(data.get('txns', {}).get('h1', {}).get('sells', 0))
-            cursor.execute("INSERT INTO market_data (token_id, timestamp, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1) VALUES (%s, %s, %s, %s, %s, %s, %s)", (token_id, datetime.utcnow(), price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1))
-            print(f"  -> {symbol}: Preço ${price_usd:.8f}, Liq ${liquidity_usd:,.0f}")
-            death_reason = None
-            if liquidity_usd > 1 and liquidity_usd < DEATH_LIQUIDITY_THRESHOLD_USD: death_reason = f"liquidity_collapse"
-            elif volume_h1 < DEATH_VOLUME_THRESHOLD_USD and liquidity_usd > 1: death_reason = f"low_volume"
-            if death_reason:
-                cursor.execute("UPDATE tokens SET status = 'dead', death_at = %s, death_reason = %s WHERE id = %s", (datetime.utcnow(), death_reason, token_id))
-                print(f"  💀 {symbol} foi marcado como 'morto'. Motivo: {death_reason}")
-            conn.commit(); time.sleep(1)
+            onchain = fetch_onchain_market_data([pair_address for _, pair_address, _ in tokens_to_monitor])
         except Exception as e:
-            print(f"Erro ao processar {symbol}: {e}"); conn.rollback()
-    cursor.close(); conn.close()
+            print(f"Erro na leitura on-chain; usando a DexScreener para todos: {e}"); onchain = {}
+        now = datetime.utcnow()
+        for token_id, pair_address, symbol in tokens_to_monitor:
+            if pair_address in onchain: record_market_snapshot(token_id, symbol, now, (*onchain[pair_address], None, None, None), dead_ids)
+        # Pump.fun, CLMM, Orca etc. não têm leitura on-chain aqui e seguem pela DexScreener
+        tokens_to_monitor = [token for token in tokens_to_monitor if token[1] not in onchain]
+
+    if tokens_to_monitor:
+        print(f"\n📊 Coletando dados para {len(tokens_to_monitor)} token(s) ativo(s) em lotes de {DEXSCREENER_BATCH_SIZE}...")
+        batches = [tokens_to_monitor[start:start + DEXSCREENER_BATCH_SIZE] for start in range(0, len(tokens_to_monitor), DEXSCREENER_BATCH_SIZE)]
+        results = fetch_pairs_concurrently([[pair_address for _, pair_address, _ in batch] for batch in batches])
+        for batch_number, (batch, pairs_by_address) in enumerate(zip(batches, results), 1):
+            if isinstance(pairs_by_address, Exception):
+                print(f"Erro ao processar lote {batch_number}: {pairs_by_address}")
+                unsampled_ids.update(token_id for token_id, _, _ in batch); continue
+            now = datetime.utcnow()
+            for token_id, pair_address, symbol in batch:
+                data = pairs_by_address.get(pair_address)
+                if not data: continue
+                try:
+                    market_data = parse_market_data(data)
+                except (TypeError, ValueError) as e:
+                    print(f"Erro ao processar {symbol}: {e}"); continue
+                record_market_snapshot(token_id, symbol, now, market_data, dead_ids)
+    market_data_writer.flush()
+    return dead_ids, unsampled_ids
 
-# --- 6. INICIALIZAÇÃO ---
+# --- 7. INICIALIZAÇÃO ---
 
 if __name__ == "__main__":
     if not all([DATABASE_URL, RPC_URL]): 
@@ -10,7 +10,14 @@ import os
 import requests
 import time
 import psycopg2
+import psycopg2.extras
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from threading import Lock, Thread
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- 1. CONFIGURAÇÕES E VARIÁVEIS DE AMBIENTE ---
 
@@ -26,8 +33,21 @@ GOPLUS_CHAIN_ID = 'solana_mainnet'
 
 # Regras de negócio
 MAX_PAIR_AGE_HOURS = 4  # Idade máxima em horas para um par ser considerado "novo"
+CYCLE_INTERVAL_SECONDS = int(os.environ.get('CYCLE_INTERVAL_SECONDS', 900)) # Cadência alvo entre inícios de ciclo
+OVERLAP_DISCOVERY = os.environ.get('OVERLAP_DISCOVERY', 'true').lower() == 'true' # Descoberta roda em paralelo à coleta
 DEATH_LIQUIDITY_THRESHOLD_USD = 2000 # Liquidez mínima para ser considerado "vivo"
 DEATH_VOLUME_THRESHOLD_USD = 1000 # Volume mínimo em 1h para ser considerado "vivo"
+DEXSCREENER_BATCH_SIZE = 30 # Máximo de pares aceitos pela DexScreener em uma única requisição
+GOPLUS_BATCH_SIZE = int(os.environ.get('GOPLUS_BATCH_SIZE', 20)) # Endereços por chamada ao token_security da GoPlus
+KNOWN_TOKENS_CACHE_SIZE = int(os.environ.get('KNOWN_TOKENS_CACHE_SIZE', 50000)) # Endereços já gravados mantidos em memória
+
+# Sessões HTTP persistentes: conexões keep-alive por provedor e retries para erros transitórios
+HTTP_POOL_SIZES = {
+    'dexscreener': int(os.environ.get('DEXSCREENER_POOL_SIZE', 4)),
+    'goplus': int(os.environ.get('GOPLUS_POOL_SIZE', 2)),
+    'helius': int(os.environ.get('RPC_POOL_SIZE', 2)),
+}
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
 
 # --- 2. BANCO DE DADOS (PostgreSQL) ---
 
@@ -76,20 +96,94 @@ def setup_database():
     conn.close()
     print("✅ Banco de dados pronto.")
 
+# Endereços que já existem em `tokens` (LRU limitado), para evitar idas ao banco a cada ciclo
+_known_tokens = OrderedDict()
+
+def remember_known_tokens(token_addresses):
+    """Adiciona endereços ao cache de tokens conhecidos, descartando os mais antigos."""
+    for token_address in token_addresses:
+        _known_tokens[token_address] = True
+        _known_tokens.move_to_end(token_address)
+    while len(_known_tokens) > KNOWN_TOKENS_CACHE_SIZE:
+        _known_tokens.popitem(last=False)
+
+def filter_unknown_tokens(cursor, token_addresses):
+    """Retorna os endereços que ainda não estão em `tokens`, consultando o banco uma única vez por página."""
+    candidates = [address for address in dict.fromkeys(token_addresses) if address not in _known_tokens]
+    if not candidates:
+        return []
+    cursor.execute("SELECT token_address FROM tokens WHERE token_address = ANY(%s)", (candidates,))
+    existing = {row[0] for row in cursor.fetchall()}
+    remember_known_tokens(existing)
+    return [address for address in candidates if address not in existing]
+
 # --- 3. FONTES DE DADOS (APIs) ---
 
+_http_sessions = {}
+_http_sessions_lock = Lock()
+_http_latency = {}
+_http_latency_lock = Lock()
+
+def get_http_session(provider):
+    """Retorna a sessão persistente do provedor, reaproveitando conexões TCP/TLS entre chamadas."""
+    with _http_sessions_lock:
+        if provider not in _http_sessions:
+            # Retries apenas para falhas de rede e 5xx; todas as chamadas (inclusive POST JSON-RPC) são leituras
+            retry = Retry(total=HTTP_MAX_RETRIES, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), allowed_methods=None, raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZES.get(provider, 2), max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[provider] = session
+        return _http_sessions[provider]
+
+def http_request(provider, method, url, **kwargs):
+    """Faz a requisição pela sessão do provedor e registra a latência por host."""
+    started = time.perf_counter()
+    failed = True
+    try:
+        response = get_http_session(provider).request(method, url, **kwargs)
+        failed = response.status_code >= 400
+        return response
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with _http_latency_lock:
+            stats = _http_latency.setdefault(urlsplit(url).hostname, {'requests': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stats['requests'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+            if failed:
+                stats['errors'] += 1
+
+def print_http_latency_report():
+    """Mostra a latência média e máxima das chamadas HTTP por host."""
+    with _http_latency_lock:
+        for host, stats in _http_latency.items():
+            print(f"  - {host}: {stats['requests']} req, média {stats['total_ms'] / stats['requests']:.0f} ms, máx {stats['max_ms']:.0f} ms, {stats['errors']} erro(s)")
+
+def get_security_data_batch(token_addresses):
+    """Busca dados de segurança de vários tokens na GoPlus, em chamadas de até GOPLUS_BATCH_SIZE endereços."""
+    results = dict.fromkeys(token_addresses)
+    if not GOPLUS_API_KEY: return results
+    headers = {'X-API-KEY': GOPLUS_API_KEY}
+    for start in range(0, len(token_addresses), GOPLUS_BATCH_SIZE):
+        chunk = token_addresses[start:start + GOPLUS_BATCH_SIZE]
+        url = f"https://api.gopluslabs.io/api/v1/token_security/{GOPLUS_CHAIN_ID}?contract_addresses={','.join(chunk)}"
+        try:
+            response = http_request('goplus', 'GET', url, headers=headers, timeout=10)
+            response.raise_for_status()
+            result_dict = response.json().get('result') or {}
+            # A GoPlus pode devolver as chaves em minúsculas; tenta o endereço exato e depois a forma minúscula
+            lowered = {key.lower(): value for key, value in result_dict.items()}
+            for address in chunk:
+                results[address] = result_dict.get(address) or lowered.get(address.lower())
+        except requests.RequestException as e:
+            print(f"  - Erro na API GoPlus ({len(chunk)} endereço(s)): {e}")
+    return results
+
 def get_security_data(token_address):
     """Busca dados de segurança na GoPlus Security API."""
-    if not GOPLUS_API_KEY: return None
-    url = f"https://api.gopluslabs.io/api/v1/token_security/{GOPLUS_CHAIN_ID}?contract_addresses={token_address}"
-    headers = {'X-API-KEY': GOPLUS_API_KEY}
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        return response.json().get('result', {}).get(token_address.lower())
-    except requests.RequestException as e:
-        print(f"  - Erro na API GoPlus: {e}")
-        return None
+    return get_security_data_batch([token_address])[token_address]
 
 def get_holder_count_from_helius(token_address):
     """Busca o número de holders usando a Digital Asset API da Helius."""
@@ -103,7 +197,7 @@ def get_holder_count_from_helius(token_address):
             "jsonrpc": "2.0", "id": "helius-data-collector",
             "method": "getAsset", "params": {"id": token_address}
         }
-        response = requests.post(RPC_URL, headers=headers, json=payload, timeout=15)
+        response = http_request('helius', 'POST', RPC_URL, headers=headers, json=payload, timeout=15)
         response.raise_for_status()
         data = response.json()
         holder_count = data.get('result', {}).get('ownership', {}).get('owner_count', 0)
@@ -121,13 +215,11 @@ def discover_and_profile_new_pairs():
     """Busca, perfila e salva novos pares no banco de dados."""
     print(f"\n🔎 Procurando novos pares na rede {TARGET_CHAIN}...")
     try:
-        response = requests.get(f"https://api.dexscreener.com/latest/dex/search?q=new", timeout=15)
+        response = http_request('dexscreener', 'GET', "https://api.dexscreener.com/latest/dex/search?q=new", timeout=15)
         response.raise_for_status()
         pairs = response.json().get('pairs', [])
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
+        new_pairs = {}
         for pair in pairs:
             if pair.get('chainId') != TARGET_CHAIN: continue
             
@@ -136,28 +228,42 @@ def discover_and_profile_new_pairs():
             
             token_address = pair.get('baseToken', {}).get('address')
             if not token_address: continue
+            new_pairs.setdefault(token_address, pair)
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        new_addresses = filter_unknown_tokens(cursor, list(new_pairs))
+        # GoPlus (em lotes) e holders (um getAsset por token) em paralelo; o tamanho do pool de cada provedor limita a concorrência
+        with ThreadPoolExecutor(max_workers=HTTP_POOL_SIZES['helius'] + 1) as executor:
+            security_future = executor.submit(get_security_data_batch, new_addresses)
+            holder_futures = {address: executor.submit(get_holder_count_from_helius, address) for address in new_addresses}
+            security_by_address = security_future.result()
+            holder_counts = {address: future.result() for address, future in holder_futures.items()}
 
-            cursor.execute("SELECT id FROM tokens WHERE token_address = %s", (token_address,))
-            if cursor.fetchone() is None:
-                print(f"✨ Descoberto: {pair['baseToken']['symbol']} ({pair['pairAddress'][:6]}...)")
-                
-                security_data = get_security_data(token_address)
-                time.sleep(1) 
-                holder_count = get_holder_count_from_helius(token_address)
-                time.sleep(1) 
-                
-                is_honeypot = bool(int(security_data.get('is_honeypot', 0))) if security_data else None
-                buy_tax = float(security_data.get('buy_tax', 0)) if security_data else None
-                sell_tax = float(security_data.get('sell_tax', 0)) if security_data else None
-
-                cursor.execute(
-                    """
-                    INSERT INTO tokens (token_address, pair_address, chain, symbol, discovered_at, initial_holder_count, is_honeypot, buy_tax, sell_tax) 
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (token_address, pair['pairAddress'], pair['chainId'], pair['baseToken']['symbol'], datetime.utcnow(), holder_count, is_honeypot, buy_tax, sell_tax)
-                )
-                conn.commit()
+        rows = []
+        for token_address in new_addresses:
+            pair = new_pairs[token_address]
+            print(f"✨ Descoberto: {pair['baseToken']['symbol']} ({pair['pairAddress'][:6]}...)")
+            
+            security_data = security_by_address[token_address]
+            is_honeypot = bool(int(security_data.get('is_honeypot', 0))) if security_data else None
+            buy_tax = float(security_data.get('buy_tax', 0)) if security_data else None
+            sell_tax = float(security_data.get('sell_tax', 0)) if security_data else None
+            rows.append((token_address, pair['pairAddress'], pair['chainId'], pair['baseToken']['symbol'], datetime.utcnow(), holder_counts[token_address], is_honeypot, buy_tax, sell_tax))
+
+        if rows:
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                INSERT INTO tokens (token_address, pair_address, chain, symbol, discovered_at, initial_holder_count, is_honeypot, buy_tax, sell_tax) 
+                VALUES %s
+                ON CONFLICT (token_address) DO NOTHING
+                """,
+                rows
+            )
+            conn.commit()
+            remember_known_tokens(new_addresses)
     except Exception as e:
         print(f"Erro na fase de descoberta: {e}")
     finally:
@@ -165,52 +271,84 @@ def discover_and_profile_new_pairs():
             cursor.close()
             conn.close()
 
+def fetch_pairs_batch(pair_addresses):
+    """Busca vários pares em uma única requisição à DexScreener (endereços separados por vírgula)."""
+    url = f"https://api.dexscreener.com/latest/dex/pairs/{TARGET_CHAIN}/{','.join(pair_addresses)}"
+    response = http_request('dexscreener', 'GET', url, timeout=15)
+    response.raise_for_status()
+    return {pair.get('pairAddress'): pair for pair in (response.json().get('pairs') or [])}
+
+def parse_market_data(data):
+    """Extrai preço, liquidez, volume e transações de um par da DexScreener."""
+    price_usd = float(data.get('priceUsd') or 0)
+    liquidity_usd = float((data.get('liquidity') or {}).get('usd') or 0)
+    volume_h1 = float((data.get('volume') or {}).get('h1') or 0)
+    txns_h1 = (data.get('txns') or {}).get('h1') or {}
+    buys_h1 = int(txns_h1.get('buys') or 0)
+    sells_h1 = int(txns_h1.get('sells') or 0)
+    return price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1
+
+def get_death_reason(liquidity_usd, volume_h1):
+    """Retorna o motivo da 'morte' do token, ou None se ele continua vivo."""
+    if liquidity_usd > 1 and liquidity_usd < DEATH_LIQUIDITY_THRESHOLD_USD:
+        return "liquidity_collapse"
+    if volume_h1 < DEATH_VOLUME_THRESHOLD_USD and liquidity_usd > 1:
+        return "low_volume"
+    return None
+
 def collect_and_analyze_data():
-    """Coleta dados para tokens ativos e verifica sua 'morte'."""
+    """Coleta dados para tokens ativos em lotes e verifica sua 'morte'."""
     conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute("SELECT id, pair_address, symbol FROM tokens WHERE status = 'monitoring'")
-    tokens_to_monitor = cursor.fetchall()
+    tokens_to_monitor = [row for row in cursor.fetchall() if row[1]]
 
     if not tokens_to_monitor:
         print("📊 Nenhum token ativo para monitorar.")
+        cursor.close()
+        conn.close()
         return
         
-    print(f"\n📊 Coletando dados para {len(tokens_to_monitor)} token(s) ativo(s)...")
-    for token_id, pair_address, symbol in tokens_to_monitor:
+    print(f"\n📊 Coletando dados para {len(tokens_to_monitor)} token(s) ativo(s) em lotes de {DEXSCREENER_BATCH_SIZE}...")
+    for start in range(0, len(tokens_to_monitor), DEXSCREENER_BATCH_SIZE):
+        batch = tokens_to_monitor[start:start + DEXSCREENER_BATCH_SIZE]
         try:
-            url = f"https://api.dexscreener.com/latest/dex/pairs/{TARGET_CHAIN}/{pair_address}"
-            response = requests.get(url, timeout=10)
-            data = response.json().get('pair')
-            if not data: continue
-
-            price_usd = float(data.get('priceUsd', 0))
-            liquidity_usd = float(data.get('liquidity', {}).get('usd', 0))
-            volume_h1 = float(data.get('volume', {}).get('h1', 0))
-            buys_h1 = int(data.get('txns', {}).get('h1', {}).get('buys', 0))
-            sells_h1 = int(data.get('txns', {}).get('h1', {}).get('sells', 0))
-            
-            cursor.execute(
+            pairs_by_address = fetch_pairs_batch([pair_address for _, pair_address, _ in batch])
+            now = datetime.utcnow()
+            snapshots = []
+            deaths = []
+
+            for token_id, pair_address, symbol in batch:
+                data = pairs_by_address.get(pair_address)
+                if not data: continue
+
+                try:
+                    price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1 = parse_market_data(data)
+                except (TypeError, ValueError) as e:
+                    print(f"Erro ao processar {symbol}: {e}")
+                    continue
+
+                snapshots.append((token_id, now, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1))
+                print(f"  -> {symbol}: Preço ${price_usd:.8f}, Liq ${liquidity_usd:,.0f}")
+
+                death_reason = get_death_reason(liquidity_usd, volume_h1)
+                if death_reason:
+                    deaths.append((now, death_reason, token_id))
+                    print(f"  💀 {symbol} foi marcado como 'morto'. Motivo: {death_reason}")
+
+            # Grava o lote inteiro em uma única transação
+            cursor.executemany(
                 "INSERT INTO market_data (token_id, timestamp, price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                (token_id, datetime.utcnow(), price_usd, liquidity_usd, volume_h1, buys_h1, sells_h1)
+                snapshots
+            )
+            cursor.executemany(
+                "UPDATE tokens SET status = 'dead', death_at = %s, death_reason = %s WHERE id = %s",
+                deaths
             )
-            print(f"  -> {symbol}: Preço ${price_usd:.8f}, Liq ${liquidity_usd:,.0f}")
-            
-            death_reason = None
-            if liquidity_usd > 1 and liquidity_usd < DEATH_LIQUIDITY_THRESHOLD_USD: death_reason = f"liquidity_collapse"
-            elif volume_h1 < DEATH_VOLUME_THRESHOLD_USD and liquidity_usd > 1: death_reason = f"low_volume"
-
-            if death_reason:
-                cursor.execute(
-                    "UPDATE tokens SET status = 'dead', death_at = %s, death_reason = %s WHERE id = %s",
-                    (datetime.utcnow(), death_reason, token_id)
-                )
-                print(f"  💀 {symbol} foi marcado como 'morto'. Motivo: {death_reason}")
-            
             conn.commit()
             time.sleep(1)
         except Exception as e:
-            print(f"Erro ao processar {symbol}: {e}")
+            print(f"Erro ao processar lote {start // DEXSCREENER_BATCH_SIZE + 1}: {e}")
             conn.rollback()
     
     cursor.close()
@@ -218,20 +356,44 @@ def collect_and_analyze_data():
 
 # --- 5. LOOP PRINCIPAL ---
 
+def run_cycle():
+    """Executa um ciclo. Com OVERLAP_DISCOVERY, a descoberta (que alimenta o próximo ciclo) roda enquanto a coleta acontece."""
+    discovery_thread = None
+    if OVERLAP_DISCOVERY:
+        discovery_thread = Thread(target=discover_and_profile_new_pairs, name='discovery', daemon=True)
+        discovery_thread.start()
+    else:
+        discover_and_profile_new_pairs()
+    collect_and_analyze_data()
+    if discovery_thread:
+        discovery_thread.join()
+    print_http_latency_report()
+
 if __name__ == "__main__":
     if not all([DATABASE_URL, GOPLUS_API_KEY, RPC_URL]):
         print("❌ ERRO: Verifique se as variáveis de ambiente DATABASE_URL, GOPLUS_API_KEY e RPC_URL estão configuradas.")
     else:
         setup_database()
+        # Cadência fixa: a duração do ciclo é descontada da espera até o próximo início
+        next_cycle_at = time.monotonic()
+        overruns = 0
         while True:
             try:
-                discover_and_profile_new_pairs()
-                collect_and_analyze_data()
-                print(f"\n--- Ciclo completo. Próxima verificação em 15 minutos --- ({datetime.now().strftime('%H:%M:%S')})")
-                time.sleep(900)
+                cycle_started = time.monotonic()
+                run_cycle()
+                now = time.monotonic()
+                next_cycle_at += CYCLE_INTERVAL_SECONDS
+                if now > next_cycle_at:
+                    overruns += 1
+                    print(f"⚠️ ALERTA: o ciclo levou {now - cycle_started:.0f}s, acima da cadência de {CYCLE_INTERVAL_SECONDS}s ({overruns} estouro(s) até agora).")
+                    next_cycle_at = now
+                delay = next_cycle_at - now
+                print(f"\n--- Ciclo completo em {now - cycle_started:.0f}s. Próxima verificação em {delay:.0f}s --- ({datetime.now().strftime('%H:%M:%S')})")
+                time.sleep(delay)
             except KeyboardInterrupt:
                 print("\n🛑 Bot interrompido.")
                 break
             except Exception as e:
                 print(f"❌ Erro fatal no loop principal: {e}")
                 time.sleep(60)
+                next_cycle_at = time.monotonic()
@@ -0,0 +1,84 @@
+# Testes da descoberta por streaming (logsSubscribe) contra um websocket local, sem rede.
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import AutoCrypoMarlon as bot
+
+NEW_MINT = 'NewMint1111111111111111111111111111111111111'
+AMM_ID = 'AmmPool111111111111111111111111111111111111'
+CURVE_ID = 'Curve11111111111111111111111111111111111111'
+
+def borsh_string(value):
+    encoded = value.encode('utf-8')
+    return len(encoded).to_bytes(4, 'little') + encoded
+
+def raydium_initialize2(coin_mint, pc_mint):
+    accounts = [f'Acc{index}' for index in range(18)]
+    accounts[4], accounts[8], accounts[9] = AMM_ID, coin_mint, pc_mint
+    return {'programId': bot.RAYDIUM_AMM_V4_PROGRAM_ID, 'accounts': accounts, 'data': bot.b58encode(bytes([bot.RAYDIUM_INITIALIZE2_TAG]) + bytes(16))}
+
+def test_decode_raydium_initialize2_returns_the_non_quote_mint():
+    assert bot.decode_raydium_initialize2(raydium_initialize2(bot.WSOL_MINT, NEW_MINT)) == (NEW_MINT, AMM_ID, 'N/A')
+    assert bot.decode_raydium_initialize2(raydium_initialize2(NEW_MINT, bot.WSOL_MINT)) == (NEW_MINT, AMM_ID, 'N/A')
+
+def test_decode_raydium_initialize2_ignores_other_instructions():
+    instruction = raydium_initialize2(bot.WSOL_MINT, NEW_MINT)
+    assert bot.decode_raydium_initialize2({**instruction, 'data': bot.b58encode(bytes([9]) + bytes(16))}) is None
+    assert bot.decode_raydium_initialize2({**instruction, 'accounts': instruction['accounts'][:9]}) is None
+
+def test_decode_pumpfun_create():
+    data = bot.PUMPFUN_CREATE_DISCRIMINATOR + borsh_string('Meme Coin') + borsh_string('MEME') + borsh_string('https://meta')
+    instruction = {'programId': bot.PUMPFUN_PROGRAM_ID, 'accounts': [NEW_MINT, 'Authority', CURVE_ID], 'data': bot.b58encode(data)}
+    assert bot.decode_pumpfun_create(instruction) == (NEW_MINT, CURVE_ID, 'MEME')
+    assert bot.decode_pumpfun_create({**instruction, 'data': bot.b58encode(bytes(8) + data[8:])}) is None
+
+def test_is_pool_creation():
+    marker = bot.STREAM_SOURCES['raydium'][1]
+    assert bot._is_pool_creation(['Program log: ray_log: x', marker], marker)
+    assert bot._is_pool_creation([marker + ': extra'], marker)
+    assert not bot._is_pool_creation(['Program log: initialize2x'], marker)
+    assert not bot._is_pool_creation(None, marker)
+
+def notification(subscription, signature, logs, err=None):
+    return {'jsonrpc': '2.0', 'method': 'logsNotification',
+            'params': {'subscription': subscription, 'result': {'context': {'slot': 1}, 'value': {'signature': signature, 'err': err, 'logs': logs}}}}
+
+async def run_stream_against_mock(monkeypatch, sources):
+    subscribed = []
+
+    async def handler(request):
+        ws = web.WebSocketResponse(); await ws.prepare(request)
+        for _ in sources:
+            message = await ws.receive_json(); subscribed.append(message)
+            await ws.send_json({'jsonrpc': '2.0', 'id': message['id'], 'result': 100 + message['id']})
+        raydium_marker, pumpfun_marker = bot.STREAM_SOURCES['raydium'][1], bot.STREAM_SOURCES['pumpfun'][1]
+        await ws.send_json(notification(101, 'sig-raydium', ['Program log: start', raydium_marker]))
+        await ws.send_json(notification(101, 'sig-failed', [raydium_marker], err={'InstructionError': [0, 'Custom']}))
+        await ws.send_json(notification(101, 'sig-swap', ['Program log: swap']))
+        await ws.send_json(notification(999, 'sig-unknown', [raydium_marker]))
+        await ws.send_json(notification(102, 'sig-pumpfun', [pumpfun_marker]))
+        async for _ in ws: pass # Até o cliente fechar a sessão
+        return ws
+
+    app = web.Application(); app.router.add_get('/', handler)
+    runner = web.AppRunner(app); await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0); await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(bot, 'RPC_WS_URL', f'ws://127.0.0.1:{port}/')
+    events = []
+    monkeypatch.setattr(bot, 'process_stream_event', lambda source, signature, seen_at: events.append((source, signature)))
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            await bot._stream_new_pools(sources, 1, executor)
+    finally:
+        await runner.cleanup()
+    return subscribed, events
+
+def test_stream_subscribes_and_dispatches_pool_creations(monkeypatch):
+    subscribed, events = asyncio.run(run_stream_against_mock(monkeypatch, ['raydium', 'pumpfun']))
+    assert [message['params'][0] for message in subscribed] == [{'mentions': [bot.RAYDIUM_AMM_V4_PROGRAM_ID]}, {'mentions': [bot.PUMPFUN_PROGRAM_ID]}]
+    assert all(message['method'] == 'logsSubscribe' for message in subscribed)
+    # Transações com erro, logs sem o marcador e assinaturas desconhecidas são ignorados
+    assert events == [('raydium', 'sig-raydium'), ('pumpfun', 'sig-pumpfun')]